@@ -59,3 +59,72 @@ def time_chunker(input_gen, grid_size, timers, keep_types=True, n_grid=np.inf):
             idx, next_stop = _next_grid(total, grid_size)
         chunk_timers += deltas
         chunk_size += 1
+
+
+def time_chunker_lazy(input_gen, grid_size, timers, n_grid=np.inf):
+    '''Same as time_chunker() but with less overhead per item, so cheap
+    samplers are not penalized by the bookkeeping. The primary timer is read
+    once per item and the other timers only at the grid points, with
+    everything kept in scalars. So the other timers also count the time
+    between items, and for the item that crosses a grid point they count it
+    in the chunk that ends there rather than the next one.'''
+    assert(grid_size > 0)
+    # Possible to just pass a single timer
+    if np.ndim(timers) == 0:
+        timers = [('time', timers)]
+    assert(np.ndim(timers) == 2 and np.shape(timers)[1] == 2)
+    timer_names, __ = zip(*timers)
+    assert(CHUNK_SIZE not in timer_names)
+    assert(GRID_INDEX not in timer_names)
+
+    (primary_name, primary_f), extra = timers[0], timers[1:]
+
+    total = 0
+    idx = 0  # Note: this gives a stop the first time around
+    chunk_size = 0
+    next_stop = grid_size * idx
+    # Preserve dtypes by initializing by a call
+    chunk_primary = 0 * primary_f()
+    extra_start = [f() for _, f in extra]
+    last = primary_f()
+    while idx < n_grid:  # StopIteration from input_gen will break loop too.
+        next_item = next(input_gen)
+        now = primary_f()
+        delta = now - last
+        last = now
+        # Allowing =0 for now, but that could have weird corner cases
+        assert(delta >= 0)
+        total += delta
+
+        if total > next_stop:
+            assert(idx == 0 or chunk_size > 0)  # Should be impossible
+            timer_dict = {name: f() - x0
+                          for (name, f), x0 in zip(extra, extra_start)}
+            timer_dict[primary_name] = chunk_primary
+            timer_dict[CHUNK_SIZE] = chunk_size
+            timer_dict[GRID_INDEX] = idx
+            yield next_item, timer_dict
+
+            # Setup next round, time spent by caller is not counted
+            chunk_primary *= 0
+            chunk_size = 0
+            idx, next_stop = _next_grid(total, grid_size)
+            extra_start = [f() for _, f in extra]
+            last = primary_f()
+        chunk_primary += delta
+        chunk_size += 1
+
+
+def calibrate_overhead(chunker, input_gen, grid_size, timers, n_grid=11):
+    '''Estimate the overhead per item of chunker, and anything wrapped around
+    input_gen, by running it on a no-op input_gen. Returns the median over
+    grid chunks of the primary timer per item.'''
+    primary_name = 'time' if np.ndim(timers) == 0 else timers[0][0]
+
+    TC = chunker(input_gen, grid_size, timers, n_grid=n_grid)
+    # Skip first chunk since it is always empty
+    rate = [metarow[primary_name] / float(metarow[CHUNK_SIZE])
+            for _, metarow in TC if metarow[CHUNK_SIZE] > 0]
+    assert(len(rate) > 0)
+    overhead = np.median(rate)
+    return overhead
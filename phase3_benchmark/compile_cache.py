@@ -0,0 +1,134 @@
+# Ryan Turner (turnerry@iro.umontreal.ca)
+import cPickle as pkl
+from contextlib import contextmanager
+import hashlib
+import os
+import warnings
+import pymc3 as pm
+from pymc3.step_methods import metropolis
+from pymc3.step_methods.hmc import base_hmc
+from pymc3.step_methods.hmc.trajectory import Hamiltonian
+import theano
+import fileio as io
+
+# Skip graph optimization when loading, that is most of what we want to save.
+theano.config.reoptimize_unpickled_function = False
+
+# In-process cache of compiled functions, shared across experiments when
+# several run in the same process (e.g., run_all.py).
+_compiled = {}
+
+
+def file_hash(fname, block_size=2 ** 20):
+    '''Hash of file contents, so a retrained benchmark gets a new key.'''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def build_key(param_hash, model_name, tag, sep='-'):
+    # Theano version and floatX also change the compiled function
+    key = sep.join((param_hash, model_name, tag,
+                    theano.__version__, theano.config.floatX))
+    return key
+
+
+def get_function(key, build_f, cache_dir=None, ext='.pkl'):
+    '''Get compiled theano function for key, build_f() is only called (and
+    result saved to cache_dir) on a miss in both the in-process and on-disk
+    cache. cache_dir=None disables the on-disk cache.'''
+    if key in _compiled:
+        return _compiled[key]
+
+    fname = None
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + ext)
+        assert(os.path.isabs(fname))
+
+    f = None
+    if fname is not None and os.path.isfile(fname):
+        print 'loading compiled function %s' % fname
+        try:
+            with open(fname, 'rb') as fh:
+                f = pkl.load(fh)
+        except Exception as err:
+            warnings.warn('failed to load %s, recompiling: %s' %
+                          (fname, str(err)))
+
+    if f is None:
+        f = build_f()
+        if fname is not None:
+            io.makedirs_safe(cache_dir)
+            # Unique temp name since concurrent jobs may save the same key
+            tmp_fname = io.get_temp_filename(cache_dir, 'tmp', ext)
+            with io.atomic_write(fname, tmp_fname) as fh:
+                pkl.dump(f, fh, pkl.HIGHEST_PROTOCOL)
+            print 'saved compiled function %s' % fname
+    _compiled[key] = f
+    return f
+
+
+def obj_hash(obj):
+    '''Hash of picklable obj, to put settings baked into a graph in a key.'''
+    h = hashlib.sha1(pkl.dumps(obj, pkl.HIGHEST_PROTOCOL)).hexdigest()
+    return h
+
+
+@contextmanager
+def pymc3_cache(key_f, cache_dir=None, on_get=None):
+    '''Within this context the pymc3 step methods get their compiled
+    functions from the cache rather than compiling them: Metropolis (and
+    proposal variants), HMC, NUTS, and Slice. key_f(tag) gives the key for
+    each function tag, use build_key(). on_get(f) is called on every compiled
+    function handed out, e.g., to re-attach counters. Only for a model with a
+    single free variable since the keys do not say which variables a step
+    samples.'''
+    on_get = (lambda f: None) if on_get is None else on_get
+    delta_logp_orig = metropolis.delta_logp
+    hamiltonian_orig = base_hmc.get_theano_hamiltonian_functions
+    # Model inherits fastlogp from Factor, which the RVs also use
+    assert('fastlogp' not in pm.Model.__dict__)
+    fastlogp_orig = pm.Model.fastlogp
+
+    def delta_logp(logp, vars, shared):
+        f = get_function(key_f('delta_logp'),
+                         lambda: delta_logp_orig(logp, vars, shared),
+                         cache_dir)
+        f.trust_input = True  # Not kept when pickled
+        on_get(f)
+        return f
+
+    def hamiltonian(model_vars, shared, logpt, potential, *args, **kwargs):
+        # Potential (scaling) and options are constants in the graph
+        settings = (potential, args, sorted(kwargs.items()))
+        tag = 'hamiltonian-' + obj_hash(settings)
+
+        def build_f():
+            R = hamiltonian_orig(model_vars, shared, logpt, potential,
+                                 *args, **kwargs)
+            return R[1:]  # Only the compiled functions, not the graph in H
+        all_f = get_function(key_f(tag), build_f, cache_dir)
+        for f in all_f:
+            f.trust_input = True
+            on_get(f)
+        # Steps only use the potential of H after compiling
+        H = Hamiltonian(None, None, potential)
+        return (H,) + tuple(all_f)
+
+    def fastlogp(model):
+        f = get_function(key_f('fastlogp'), lambda: fastlogp_orig.fget(model),
+                         cache_dir)
+        on_get(f.f)
+        return f
+
+    metropolis.delta_logp = delta_logp
+    base_hmc.get_theano_hamiltonian_functions = hamiltonian
+    pm.Model.fastlogp = property(fastlogp)
+    try:
+        yield
+    finally:
+        metropolis.delta_logp = delta_logp_orig
+        base_hmc.get_theano_hamiltonian_functions = hamiltonian_orig
+        del pm.Model.fastlogp
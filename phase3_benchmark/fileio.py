@@ -1,7 +1,12 @@
 # Ryan Turner (turnerry@iro.umontreal.ca)
 import ConfigParser
+from contextlib import contextmanager
 import os
 from tempfile import NamedTemporaryFile
+import numpy as np
+
+CHAIN_FORMATS = ('csv', 'npy')
+TMP_EXT = '.tmp'
 
 # ============================================================================
 # TODO move everything here to general util file
@@ -27,6 +32,32 @@ def get_temp_filename(dir_, prefix, ext):
     return fname
 
 
+def makedirs_safe(dir_):
+    '''Make dir_ if doesn't already exist, also ok if another job makes it
+    at the same time.'''
+    try:
+        os.makedirs(dir_)
+    except OSError:
+        if not os.path.isdir(dir_):
+            raise
+
+
+@contextmanager
+def atomic_write(fname, tmp_fname=None, mode='wb'):
+    '''Open file to write fname through. It is written to tmp_fname (fname
+    + TMP_EXT by default) then renamed, so a killed job or a concurrent
+    reader never sees a partial file. rename is atomic on POSIX.'''
+    tmp_fname = fname + TMP_EXT if tmp_fname is None else tmp_fname
+    try:
+        with open(tmp_fname, mode) as f:
+            yield f
+    except:  # Also catch KeyboardInterrupt so no temp file left behind
+        if os.path.isfile(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    os.rename(tmp_fname, fname)
+
+
 def chomp(ss, ext):
     L = len(ext)
     assert(ss[-L:] == ext)
@@ -40,6 +71,18 @@ def get_model_list(input_path, ext):
     return L
 
 
+def save_chain(fname, X, chain_format):
+    '''Save chain in csv (text) or npy (binary, can be memory-mapped) format.
+    Phase 4 detects which one from the file contents.'''
+    assert(chain_format in CHAIN_FORMATS)
+    if chain_format == 'npy':
+        # Use file handle since np.save() would append .npy to fname
+        with open(fname, 'wb') as f:
+            np.save(f, X, allow_pickle=False)
+    else:
+        np.savetxt(fname, X, delimiter=',')
+
+
 def build_output_name(param_name, sampler, sep='_', sub_sep='-'):
     output_name = ''.join((param_name, sep, sampler, sub_sep))
     assert(is_safe_name(output_name))
@@ -53,13 +96,15 @@ def load_config(config_file):
 
     D = {}
 
+    D['num_cores_per_job'] = config.getint('compute', 'num_cores_per_job')
+    assert(D['num_cores_per_job'] >= 1)
+
     njobs = config.get('compute', 'njobs')
     calc_njobs = njobs in ['', 'None', 'none', 'calculated', 'calculate']
     if calc_njobs:
         num_cores_per_cpu = config.getint('compute', 'num_cores_per_cpu')
         num_cpus = config.getint('compute', 'num_cpus')
-        num_cores_per_job = config.getint('compute', 'num_cores_per_job')
-        D['njobs'] = num_cores_per_cpu * num_cpus / num_cores_per_job
+        D['njobs'] = num_cores_per_cpu * num_cpus / D['num_cores_per_job']
     else:
         try:
             D['njobs'] = int(njobs)
@@ -80,11 +125,26 @@ def load_config(config_file):
     assert(D['n_exact'] > 0)
     D['n_chains'] = config.getint('phase3', 'n_chains')
     assert(D['n_chains'] >= 0)
+    D['chains_per_job'] = config.getint('phase3', 'chains_per_job')
+    assert(D['chains_per_job'] >= 1)
+    D['resume'] = config.getboolean('phase3', 'resume')
+    D['lazy_timers'] = config.getboolean('phase3', 'lazy_timers')
+    D['calibrate_overhead'] = config.getboolean('phase3', 'calibrate_overhead')
+
+    # Leave blank to only use in-process cache of compiled functions
+    cache_path = config.get('phase3', 'compile_cache_path')
+    D['compile_cache_path'] = None if cache_path == '' else \
+        abspath2(cache_path)
 
     D['csv_ext'] = config.get('common', 'csv_ext')
+    D['npy_ext'] = config.get('common', 'npy_ext')
     D['pkl_ext'] = config.get('common', 'pkl_ext')
     D['meta_ext'] = config.get('common', 'meta_ext')
     D['exact_name'] = config.get('common', 'exact_name')
     assert(D['exact_name'].isalnum())
 
+    D['chain_format'] = config.get('phase3', 'chain_format')
+    assert(D['chain_format'] in CHAIN_FORMATS)
+    D['chain_ext'] = D[D['chain_format'] + '_ext']
+
     return D
@@ -0,0 +1,60 @@
+# Ryan Turner (turnerry@iro.umontreal.ca)
+import os
+from time import time
+
+PLANNED = 'planned'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+ALL_STATUS = (PLANNED, RUNNING, COMPLETED, FAILED)
+
+LEDGER_NAME = 'jobs.ledger'  # Not csv_ext so phase 4 does not pick it up
+SEP = '\t'
+
+
+def job_name(param_name, sampler, chain, sep='_'):
+    job = sep.join((param_name, sampler, str(chain)))
+    return job
+
+
+def get_ledger_file(output_path):
+    fname = os.path.join(output_path, LEDGER_NAME)
+    assert(os.path.isabs(fname))
+    return fname
+
+
+def record(fname, job, status, output=''):
+    '''Append a status line for job to the ledger. The ledger is append only
+    and each line goes in a single os.write() with O_APPEND so that concurrent
+    workers do not interleave partial lines.'''
+    assert(status in ALL_STATUS)
+    assert(SEP not in job and SEP not in output and '\n' not in output)
+    line = SEP.join((job, status, output, '%f' % time())) + '\n'
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def load_status(fname):
+    '''Get dict of job -> (status, output) using the latest line for each.'''
+    status = {}
+    if not os.path.isfile(fname):
+        return status
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split(SEP)
+            if len(fields) != 4:  # Tolerate partial line from crash
+                continue
+            job, curr_status, output, _ = fields
+            status[job] = (curr_status, output)
+    return status
+
+
+def is_done(status, job):
+    '''Only trust completed if the output is still on disk. Running means the
+    worker died (or is still going on another node) and failed is retried.'''
+    curr_status, output = status.get(job, (PLANNED, ''))
+    done = curr_status == COMPLETED and os.path.isfile(output)
+    return done
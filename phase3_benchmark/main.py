@@ -1,5 +1,6 @@
 # Ryan Turner (turnerry@iro.umontreal.ca)
 import cPickle as pkl
+from itertools import repeat
 import os
 import sys
 import warnings
@@ -7,14 +8,17 @@ from emcee.autocorr import integrated_time
 import numpy as np
 import pandas as pd
 import pymc3 as pm
-from pymc3.backends.tracetab import trace_to_dataframe
+from pymc3.step_methods import CompoundStep
 import theano
 import theano.tensor as T
 from models import BUILD_MODEL, SAMPLE_MODEL
 from samplers import BUILD_STEP_PM, BUILD_STEP_MC
-from chunker import time_chunker
+from chunker import time_chunker, time_chunker_lazy, calibrate_overhead
 from chunker import CHUNK_SIZE, GRID_INDEX
+import compile_cache as cc
 import fileio as io
+import ledger
+import trace_writer as tw
 # These modules should be replaced with better options if phase3 goes Python3
 from time import time as wall_time
 from time import clock as cpu_time
@@ -26,11 +30,58 @@ SAMPLE_INDEX_COL = 'sample'
 DATA_CENTER = 'data_center'
 DATA_SCALE = 'data_scale'
 MAX_N = 10 ** 5  # Some value to prevent blowing out HDD space with samples.
+MAX_REPORT_N = 10 ** 4  # Max samples to load for sanity check report
+COUNTER_NAME = 'function_calls'
+OVERHEAD_COL = 'chunk_overhead_s'
+CORRECTED_COL = 'corrected_time_s'
+CALIB_GRID_S = 0.01  # Calibrate for CALIB_N_GRID * CALIB_GRID_S seconds
+CALIB_N_GRID = 11
+
+
+def step_gen(steps, start, draws, model=None):
+    '''Same loop as pm.sampling.iter_sample() but without building a trace,
+    which pre-allocates draws samples in memory and gets sliced every step.
+    Instead yield each point and let the caller store what it needs.'''
+    model = pm.modelcontext(model)
+    try:
+        step = CompoundStep(steps)
+    except TypeError:
+        step = steps
+
+    point = pm.Point(start, model=model)
+    for _ in xrange(draws):
+        if step.generates_stats:
+            point, _ = step.step(point)
+        else:
+            point = step.step(point)
+        yield point
+
+
+class NoopStep(object):
+    '''Step that stays put, to time the harness around the real steps.'''
+    generates_stats = False
+
+    def step(self, point):
+        return point
+
+
+def thinned_gen(sample_gen, chain, thin, n_iters):
+    '''Pass through the walker positions from emcee sample_gen, keeping every
+    thin-th in chain (n_walkers x n_keep x D) and the number of iterations
+    done in n_iters[0].'''
+    for ii, (pos, _, _) in enumerate(sample_gen):
+        if ii % thin == 0:  # Same states as emcee would store
+            chain[:, ii // thin, :] = pos
+        n_iters[0] = ii + 1
+        yield pos
 
 
-def format_trace(trace):
-    df = trace_to_dataframe(trace)
-    return df.values
+def cycle_gen(build_gen):
+    '''Chain fresh build_gen() generators without end, so calibration is not
+    cut short by the limits on the real samplers.'''
+    while True:
+        for item in build_gen():
+            yield item
 
 
 def moments_report(X, epsilon=1e-12):
@@ -81,104 +132,192 @@ def get_counters():
     count = sum(int(c.get_value()) for c in all_counters)
     return count
 
+
+def register_counters(f):
+    '''Re-attach the counters of a compiled function, needed when it came
+    from the compile cache and so the graph building never ran.'''
+    for s in f.get_shared():
+        if s.name == COUNTER_NAME and all(s is not c for c in all_counters):
+            all_counters.append(s)
+
 # ============================================================================
 
 
-def sample_pymc3(logpdf_tt, sampler, start, timers, time_grid_ms, n_grid,
-                 data_scale=None):
-    assert(start.ndim == 1)
-    D, = start.shape
+def run_chain(sample_gen, timers, time_grid_ms, n_grid, chunker, get_count):
+    '''Run sample_gen on the time grid, returns the meta-data rows and number
+    of items up to the last grid point. get_count() gives the number of items
+    drawn from sample_gen so far, to check the chunk sizes against.'''
+    time_grid_s = 1e-3 * time_grid_ms
+    TC = chunker(sample_gen, time_grid_s, timers, n_grid=n_grid)
 
+    print 'starting to sample'
+    # This could all go in a list comp if we get rid of the assert check
+    cum_size = 0
+    meta = []
+    for _, metarow in TC:
+        meta.append(metarow)
+        cum_size += metarow[CHUNK_SIZE]
+        assert(cum_size == get_count() - 1)
+    return meta, cum_size
+
+
+def sample_pymc3(logpdf_tt, sampler, starts, timers, time_grid_ms, n_grid,
+                 writers, data_scale=None, cache_key_f=None, cache_dir=None,
+                 chunker=time_chunker, calibrate=False, on_chain_done=None):
+    '''Run a chain from each of starts, sharing the model. Samples of each
+    chain are streamed to its writer as they come in. If cache_key_f is given
+    the steps get their compiled functions from the compile cache, with
+    cache_key_f(tag) giving the key for each. chunker is time_chunker() or a
+    drop in replacement like time_chunker_lazy(). If calibrate, the harness
+    overhead is estimated first and goes in the meta-data. Returns list of
+    meta-data, on_chain_done(c_num, meta) is also called as each chain is
+    done.'''
+    assert(len(starts) == len(writers))
+    assert(all(start.ndim == 1 for start in starts))
+    D, = starts[0].shape
+
+    all_meta = []
     with pm.Model():
         pm.DensityDist('x', logpdf_tt, shape=D)
 
-        step_kwds = {}
-        if data_scale is not None:
-            assert(data_scale.shape == (D,))
-            step_kwds['scaling'] = data_scale
-        print 'step arguments'
-        print step_kwds
-
-        steps = BUILD_STEP_PM[sampler](step_kwds)
-
-        sample_gen = pm.sampling.iter_sample(MAX_N, steps, start={'x': start})
-
-        time_grid_s = 1e-3 * time_grid_ms
-        TC = time_chunker(sample_gen, time_grid_s, timers, n_grid=n_grid)
-
-        print 'starting to sample'
-        # This could all go in a list comp if we get rid of the assert check
-        cum_size = 0
-        meta = []
-        for trace, metarow in TC:
-            meta.append(metarow)
-            cum_size += metarow[CHUNK_SIZE]
-            assert(cum_size == len(trace) - 1)
-    # Build rep for trace data
-    trace = format_trace(trace)
-    return trace, meta
-
-
-def sample_emcee(logpdf_tt, sampler, start, timers, time_grid_ms, n_grid,
-                 n_walkers_min=50, thin=100, data_scale=None, ball_size=1e-6):
-    '''Use default thin of 100 since otherwise too fast and could blow out
-    memory with samples on high time limit.'''
-    assert(start.ndim == 1)
-    D, = start.shape
+        overhead = None
+        if calibrate:
+            # Same wrappers as the chains below around a step that stays put,
+            # with a sink that does not fill the disk.
+            sink = tw.NullWriter(D)
+            noop_gen = cycle_gen(lambda: step_gen(NoopStep(),
+                                                  {'x': np.zeros(D)}, MAX_N))
+            noop_gen = tw.record_gen(noop_gen, sink, lambda pt: pt['x'])
+            overhead = harness_overhead(chunker, timers, noop_gen)
+
+        for c_num, (start, writer) in enumerate(zip(starts, writers)):
+            step_kwds = {}
+            if data_scale is not None:
+                assert(data_scale.shape == (D,))
+                step_kwds['scaling'] = data_scale
+            print 'step arguments'
+            print step_kwds
+
+            # New steps for each chain so no adaptation state is shared, but
+            # the compiled functions are shared through the cache.
+            if cache_key_f is None:
+                steps = BUILD_STEP_PM[sampler](step_kwds)
+            else:
+                with cc.pymc3_cache(cache_key_f, cache_dir,
+                                    on_get=register_counters):
+                    steps = BUILD_STEP_PM[sampler](step_kwds)
+
+            sample_gen = step_gen(steps, {'x': start}, MAX_N)
+            sample_gen = tw.record_gen(sample_gen, writer,
+                                       lambda pt: pt['x'])
+            meta, cum_size = run_chain(sample_gen, timers, time_grid_ms,
+                                       n_grid, chunker, writer.__len__)
+            # Drop anything sampled after last grid point, like a trace
+            # from the end.
+            writer.truncate(cum_size + 1)
+            meta = build_meta(meta, n_grid, overhead, timers[0][0])
+            all_meta.append(meta)
+            if on_chain_done is not None:
+                on_chain_done(c_num, meta)
+    return all_meta
+
+
+def sample_emcee(logpdf_tt, sampler, starts, timers, time_grid_ms, n_grid,
+                 writers, n_walkers_min=50, thin=100, data_scale=None,
+                 ball_size=1e-6, cache_key=None, cache_dir=None,
+                 chunker=time_chunker, calibrate=False, on_chain_done=None):
+    '''Run a chain from each of starts, sharing the compiled logpdf. Use
+    default thin of 100 since otherwise too fast and could blow out disk
+    space with samples on high time limit. If cache_key is given the compiled
+    logpdf is looked up in the compile cache. logpdf_tt must work on N x D
+    matrix input. Same calibrate and on_chain_done as sample_pymc3(). The
+    sample column of the meta-data counts rows stored in the trace rather
+    than iterations.'''
+    assert(len(starts) == len(writers))
+    assert(all(start.ndim == 1 for start in starts))
+    D, = starts[0].shape
     data_scale = np.ones(D) if data_scale is None else data_scale
     assert(data_scale.shape == (D,))
 
     n_walkers = max(2 * D + 2, n_walkers_min)
-    ball = (ball_size * data_scale[None, :]) * np.random.randn(n_walkers, D)
-    start = ball + start[None, :]
+
+    def to_row(n):
+        # Iterations 0, thin, 2 * thin, ... are kept, n_walkers rows each
+        return n_walkers * ((n + thin - 1) // thin)
 
     # emcee does not need gradients so we could pass np only implemented
     # version if that is less overhead, but not that is not clear. So, just
-    # compile the theano version.
-    x_tt = T.vector('x')
-    x_tt.tag.test_value = np.zeros(D)
-    logpdf_val = logpdf_tt(x_tt)
-    logpdf_f = theano.function([x_tt], logpdf_val)
-
-    print 'running emcee with %d, %d' % (n_walkers, D)
-    sampler_obj = BUILD_STEP_MC[sampler](n_walkers, D, logpdf_f)
-
-    print 'doing init'
-    # Might want to consider putting save chain to false since emcee uses
-    # np.concat to grow chain. Might be less overhead to append to list in the
-    # loop below.
-    sample_gen = sampler_obj.sample(start, iterations=(MAX_N * thin) / n_walkers, thin=thin,
-                                    storechain=True)
-
-    time_grid_s = 1e-3 * time_grid_ms
-    TC = time_chunker(sample_gen, time_grid_s, timers, n_grid=n_grid)
-
-    print 'starting to sample'
-    # This could all go in a list comp if we get rid of the assert check
-    cum_size = 0
-    meta = []
-    for trace, metarow in TC:
-        meta.append(metarow)
-        cum_size += metarow[CHUNK_SIZE]
-        # assert(sampler_obj.chain.shape == (n_walkers, MAX_N, D))
-    # Build rep for trace data
-    # Same as:
-    # np.concatenate([X[ii, :, :] for ii in xrange(X.shape[0])], axis=0)
-    # EnsembleSampler.flatchain does this too but doesn't truncate at cum_size
-    trace = np.reshape(sampler_obj.chain[:, :cum_size, :], (-1, D))
-    # TODO
-    # assert(trace.shape == (cum_size * n_walkers, D))
-
-    # Log the emcee version of autocorr for future ref
-    try:
-        tau = integrated_time(trace, axis=0)
-        print 'flat auto-corr'
-        print tau
-    except Exception as err:
-        print 'emcee autocorr est failed'
-        print str(err)
-
-    return trace, meta
+    # compile the theano version. Use N x D version so all walkers proposed
+    # at once are done in one call rather than one python call each.
+    def build_logpdf_f():
+        x_tt = T.matrix('x')
+        x_tt.tag.test_value = np.zeros((2, D))
+        logpdf_val = logpdf_tt(x_tt)
+        logpdf_f = theano.function([x_tt], logpdf_val)
+        return logpdf_f
+
+    if cache_key is None:
+        logpdf_f = build_logpdf_f()
+    else:
+        logpdf_f = cc.get_function(cache_key, build_logpdf_f, cache_dir)
+        register_counters(logpdf_f)
+
+    # Keep the thinned chain ourselves rather than with storechain, where
+    # emcee pre-allocates its full chain and lnprob and grows them with
+    # np.concatenate. The OS only commits the pages of chain we fill, so
+    # memory use follows how many samples we get in the time budget. Each
+    # chain is written out before the next one reuses the buffer.
+    n_keep = MAX_N // n_walkers
+    chain = np.zeros((n_walkers, n_keep, D))
+
+    overhead = None
+    if calibrate:
+        # Same thinned store as the chains below around a no-op sampler
+        noop_item = (np.zeros((n_walkers, D)), None, None)
+        noop_gen = cycle_gen(lambda: thinned_gen(
+            repeat(noop_item, n_keep * thin), chain, thin, [0]))
+        overhead = harness_overhead(chunker, timers, noop_gen)
+
+    all_meta = []
+    for c_num, (start, writer) in enumerate(zip(starts, writers)):
+        ball = (ball_size * data_scale[None, :]) * \
+            np.random.randn(n_walkers, D)
+        start = ball + start[None, :]
+
+        print 'running emcee with %d, %d' % (n_walkers, D)
+        sampler_obj = BUILD_STEP_MC[sampler](n_walkers, D, logpdf_f)
+
+        print 'doing init'
+        n_iters = [0]  # Iterations done, in list so generator can update it
+        sample_gen = sampler_obj.sample(start, iterations=n_keep * thin,
+                                        storechain=False)
+        sample_gen = thinned_gen(sample_gen, chain, thin, n_iters)
+        meta, _ = run_chain(sample_gen, timers, time_grid_ms, n_grid,
+                            chunker, lambda: n_iters[0])
+        # Build rep for trace data, only the part of chain that got filled
+        n_stored = to_row(n_iters[0]) // n_walkers
+        # Stack all walkers of each kept state, rather than each walker's
+        # whole chain in turn, so any prefix of the trace covers a prefix of
+        # the run time. Same as:
+        # np.concatenate([X[:, ii, :] for ii in xrange(n_stored)], axis=0)
+        trace = np.reshape(np.swapaxes(chain[:, :n_stored, :], 0, 1), (-1, D))
+        assert(trace.shape == (n_walkers * n_stored, D))
+
+        # Log the emcee version of autocorr for future ref
+        try:
+            tau = integrated_time(trace, axis=0)
+            print 'flat auto-corr'
+            print tau
+        except Exception as err:
+            print 'emcee autocorr est failed'
+            print str(err)
+
+        writer.extend(trace)
+        meta = build_meta(meta, n_grid, overhead, timers[0][0], to_row)
+        all_meta.append(meta)
+        if on_chain_done is not None:
+            on_chain_done(c_num, meta)
+    return all_meta
 
 
 def init_setup(logpdf_tt, D, init='advi'):
@@ -190,9 +329,22 @@ def init_setup(logpdf_tt, D, init='advi'):
     return start, scale
 
 
-def controller(model_setup, sampler, time_grid_ms, n_grid,
-               start_mode='default', scale_mode='default', n_ref_exact=1000):
+def controller(model_setup, sampler, time_grid_ms, n_grid, writers,
+               start_mode='default', scale_mode='default', n_ref_exact=1000,
+               param_hash=None, cache_dir=None, lazy_timers=False,
+               calibrate=False, on_chain_done=None):
+    '''Run one independent chain for each TraceWriter in writers, one after
+    another in this process so they share the model, compiled functions, and
+    initialization. Each chain gets its own time grid and returns its own
+    meta-data, in a list in the same order as writers. on_chain_done(c_num,
+    meta) is called as soon as each chain is done, so it can be saved before
+    the next one starts. param_hash identifies the parameter file for the
+    compile cache, leave as None to always compile from scratch. lazy_timers
+    uses time_chunker_lazy() to cut the overhead of timing each iteration. If
+    calibrate, the harness overhead is estimated and saved in the meta-data
+    along with the time axis corrected for it.'''
     assert(time_grid_ms > 0)
+    chunker = time_chunker_lazy if lazy_timers else time_chunker
 
     model_name, D, params_dict = model_setup
     assert(model_name in BUILD_MODEL)
@@ -212,10 +364,12 @@ def controller(model_setup, sampler, time_grid_ms, n_grid,
 
     # Use default arg trick to get params to bind to model now
     def logpdf(x, p=params_dict):
+        '''x is vector, or N x D matrix to get N vector of logpdfs.'''
         # This is Fred's trick to implicitly count function evals in theano.
-        s = theano.shared(0, name='function_calls')
+        s = theano.shared(0, name=COUNTER_NAME)
         all_counters.append(s)
-        s.default_update = s + 1
+        # Count each row as a function eval to keep the same meaning
+        s.default_update = s + (1 if x.ndim == 1 else x.shape[0])
 
         # Benchmark was trained on standardized data, but we want to sample in
         # scale of original problem to be realistic.
@@ -232,13 +386,16 @@ def controller(model_setup, sampler, time_grid_ms, n_grid,
     if start_mode == 'advi' or scale_mode == 'advi':
         advi_start, advi_scale = init_setup(logpdf, D)
 
-    start = None
+    n_chains = len(writers)
+    assert(n_chains >= 1)
+    starts = [None] * n_chains
     if start_mode == 'exact':
-        start = sample_exact(model_name, D, params_dict, N=1)[0, :]
-        assert(start.shape == (D,))
+        # Each chain gets its own start
+        starts = list(sample_exact(model_name, D, params_dict, N=n_chains))
+        assert(all(start.shape == (D,) for start in starts))
     elif start_mode == 'advi':
-        start = advi_start
-        assert(start.shape == (D,))
+        starts = [advi_start] * n_chains
+        assert(advi_start.shape == (D,))
     else:
         assert(start_mode == 'default')
 
@@ -252,19 +409,9 @@ def controller(model_setup, sampler, time_grid_ms, n_grid,
     else:
         assert(scale_mode == 'default')
 
-    reset_counters()
-    if sampler in BUILD_STEP_PM:
-        trace, meta = sample_pymc3(logpdf, sampler, start,
-                                   timers, time_grid_ms, n_grid,
-                                   data_scale)
-    else:
-        assert(sampler in BUILD_STEP_MC)
-        # Intentionally not passing data_scale, since emcee doesn't seem to
-        # have a good way to use it, built in.
-        trace, meta = sample_emcee(logpdf, sampler, start,
-                                   timers, time_grid_ms, n_grid)
-    moments_report(trace)
-
+    # Exact samples for the sanity checks, drawn up front so each chain can
+    # be checked as soon as it is done.
+    X_exact = None
     if n_ref_exact > 0:
         X_exact = sample_exact(model_name, D, params_dict, N=n_ref_exact)
         print 'std exact'
@@ -272,11 +419,49 @@ def controller(model_setup, sampler, time_grid_ms, n_grid,
 
         scaler = StandardScaler()
         X_exact = scaler.fit_transform(X_exact)
-        X_std = scaler.transform(trace)
-        err = np.mean((np.mean(X_exact, axis=0) - np.mean(X_std, axis=0)) ** 2)
-        print 'sq err %f' % err
 
-    # Build a meta-data df
+    def chain_done(c_num, meta):
+        # Subsample for the sanity checks so we don't load the whole chain
+        trace = writers[c_num].view()
+        trace = np.asarray(trace[::max(1, len(trace) // MAX_REPORT_N), :])
+        moments_report(trace)
+
+        if X_exact is not None:
+            X_std = scaler.transform(trace)
+            err = np.mean((np.mean(X_exact, axis=0) -
+                           np.mean(X_std, axis=0)) ** 2)
+            print 'sq err %f' % err
+
+        if on_chain_done is not None:
+            on_chain_done(c_num, meta)
+
+    # Same machine and harness for all chains, so only calibrated once in
+    # the sample function before the first chain.
+    reset_counters()
+    if sampler in BUILD_STEP_PM:
+        cache_key_f = None if param_hash is None else \
+            (lambda tag: cc.build_key(param_hash, model_name, tag))
+        all_meta = sample_pymc3(logpdf, sampler, starts, timers, time_grid_ms,
+                                n_grid, writers, data_scale,
+                                cache_key_f=cache_key_f, cache_dir=cache_dir,
+                                chunker=chunker, calibrate=calibrate,
+                                on_chain_done=chain_done)
+    else:
+        assert(sampler in BUILD_STEP_MC)
+        # Intentionally not passing data_scale, since emcee doesn't seem to
+        # have a good way to use it, built in.
+        cache_key = None if param_hash is None else \
+            cc.build_key(param_hash, model_name, 'logpdf_vec')
+        all_meta = sample_emcee(logpdf, sampler, starts, timers, time_grid_ms,
+                                n_grid, writers, cache_key=cache_key,
+                                cache_dir=cache_dir, chunker=chunker,
+                                calibrate=calibrate, on_chain_done=chain_done)
+    return all_meta
+
+def build_meta(meta, n_grid, overhead=None, primary_name=None, to_row=None):
+    '''Build a meta-data df from list of rows from chunker. If overhead per
+    iteration is given, also add overhead and corrected primary timer. to_row
+    maps iterations to rows of the trace when they are not one to one.'''
     meta = pd.DataFrame(meta)
     meta.set_index(GRID_INDEX, drop=True, inplace=True)
     assert(meta.index[0] == 0 and meta.index[-1] < n_grid)
@@ -284,8 +469,25 @@ def controller(model_setup, sampler, time_grid_ms, n_grid,
     assert(np.all(meta.values >= 0))  # Will also catch nans
     meta = meta.reindex(index=xrange(n_grid), fill_value=0)
     meta[SAMPLE_INDEX_COL] = meta[CHUNK_SIZE].cumsum()
+    if to_row is not None:
+        meta[SAMPLE_INDEX_COL] = to_row(meta[SAMPLE_INDEX_COL].values)
     # Could assert iter and index dtype is int here to be really safe
-    return trace, meta
+    if overhead is not None:
+        meta[OVERHEAD_COL] = overhead * meta[CHUNK_SIZE]
+        meta[CORRECTED_COL] = \
+            (meta[primary_name] - meta[OVERHEAD_COL]).cumsum()
+    return meta
+
+
+def harness_overhead(chunker, timers, noop_gen):
+    '''Time the harness alone: the chunker and whatever the sampler is wrapped
+    in, here around the no-op sampler noop_gen, on this machine with the same
+    timers. The energy call counter inside the logpdf graph is not included.
+    Returns primary timer per iteration.'''
+    overhead = calibrate_overhead(chunker, noop_gen, CALIB_GRID_S, timers,
+                                  n_grid=CALIB_N_GRID)
+    print 'harness overhead %es per iter' % overhead
+    return overhead
 
 
 def sample_exact(model_name, D, params_dict, N=1):
@@ -297,9 +499,17 @@ def sample_exact(model_name, D, params_dict, N=1):
     return X
 
 
-def run_experiment(config, param_name, sampler):
+def run_experiment(config, param_name, sampler, n_chains=1,
+                   on_chain_done=None):
+    '''Run n_chains independent chains of sampler in this process, so they
+    share the model loading and compiling. Each chain's data and meta-data
+    are saved as soon as it is done, then on_chain_done(c_num, data_file) is
+    called. If a chain fails only it and the chains not run yet are lost.
+    Returns list of their data files. The exact sampler only draws one set of
+    samples.'''
     assert(sampler == config['exact_name'] or
            (sampler in BUILD_STEP_PM) or (sampler in BUILD_STEP_MC))
+    assert(n_chains >= 1)
 
     model_file = param_name + config['pkl_ext']
     model_file = os.path.join(config['input_path'], model_file)
@@ -310,32 +520,99 @@ def run_experiment(config, param_name, sampler):
     model_name, D, params_dict = model_setup
     assert(model_name in SAMPLE_MODEL)
 
-    # Now sample
-    meta = None
+    # Now sample and save the data
     if sampler == config['exact_name']:
+        assert(n_chains == 1)
         X = sample_exact(model_name, D, params_dict, N=config['n_exact'])
-    else:
-        X, meta = controller(model_setup, sampler,
-                             config['t_grid_ms'], config['n_grid'],
-                             config['start_mode'], config['scale_mode'])
-    # Now save the data
-    data_file = io.build_output_name(param_name, sampler)
-    data_file = io.get_temp_filename(config['output_path'], data_file,
-                                     config['csv_ext'])
-    print 'saving samples to %s' % data_file
-    np.savetxt(data_file, X, delimiter=',')
-
-    # Save meta data
-    if meta is not None:
-        meta_file = data_file + config['meta_ext']
+        data_file = io.build_output_name(param_name, sampler)
+        data_file = io.get_temp_filename(config['output_path'], data_file,
+                                         config['chain_ext'])
+        print 'saving samples to %s' % data_file
+        io.save_chain(data_file, X, config['chain_format'])
+        if on_chain_done is not None:
+            on_chain_done(0, data_file)
+        return [data_file]
+
+    param_hash = cc.file_hash(model_file)
+    # Stream samples to disk as we go rather than hold them in memory
+    prefix = io.build_output_name(param_name, sampler)
+    writers = [tw.temp_writer(config['output_path'], prefix,
+                              config['chain_ext'], D, config['chain_format'])
+               for _ in xrange(n_chains)]
+    data_files = [writer.fname for writer in writers]
+    meta_files = [data_file + config['meta_ext'] for data_file in data_files]
+    done = [False] * n_chains
+
+    def finish_chain(c_num, meta):
+        # Save meta data first, so phase 4 never sees a chain without it
+        meta_file, data_file = meta_files[c_num], data_files[c_num]
         print 'saving meta-data to %s' % meta_file
         assert(not os.path.isfile(meta_file))  # This could be warning
         assert(not meta.isnull().any().any())
         meta.to_csv(meta_file, header=True, index=False)
+        print 'saving samples to %s' % data_file
+        writers[c_num].close()
+        done[c_num] = True
+        if on_chain_done is not None:
+            on_chain_done(c_num, data_file)
+
+    try:
+        controller(model_setup, sampler,
+                   config['t_grid_ms'], config['n_grid'], writers,
+                   config['start_mode'], config['scale_mode'],
+                   param_hash=param_hash,
+                   cache_dir=config['compile_cache_path'],
+                   lazy_timers=config['lazy_timers'],
+                   calibrate=config['calibrate_overhead'],
+                   on_chain_done=finish_chain)
+    except:  # Also catch KeyboardInterrupt so no partial output left behind
+        # Chains that are already saved are kept
+        for c_num in xrange(n_chains):
+            if not done[c_num]:
+                writers[c_num].discard()
+                if os.path.isfile(meta_files[c_num]):
+                    os.remove(meta_files[c_num])
+        raise
+    assert(all(done))
+    return data_files
+
+def run_experiment_logged(config, param_name, sampler, chains):
+    '''Same as run_experiment() for the chain numbers in chains, but keeps
+    the job ledger in the output dir up to date, so a sweep can later skip
+    jobs that are already done.'''
+    ledger_file = ledger.get_ledger_file(config['output_path'])
+    jobs = [ledger.job_name(param_name, sampler, chain) for chain in chains]
+
+    for job in jobs:
+        ledger.record(ledger_file, job, ledger.RUNNING)
+    completed = set()
+
+    def chain_done(c_num, data_file):
+        ledger.record(ledger_file, jobs[c_num], ledger.COMPLETED, data_file)
+        completed.add(c_num)
+
+    try:
+        data_files = run_experiment(config, param_name, sampler,
+                                    n_chains=len(chains),
+                                    on_chain_done=chain_done)
+    except:  # Also catch KeyboardInterrupt etc so ledger not left running
+        for c_num, job in enumerate(jobs):
+            if c_num not in completed:
+                ledger.record(ledger_file, job, ledger.FAILED)
+        raise
+    return data_files
+
+def parse_chains(chains_str, sep=','):
+    '''Get list of chain numbers from string like 0,1,2'''
+    chains = [int(ss) for ss in chains_str.split(sep)]
+    assert(len(chains) >= 1 and len(set(chains)) == len(chains))
+    return chains
 
 
 def main():
-    assert(len(sys.argv) == 4)
+    # Chain numbers are optional, only needed to keep the job ledger. Give a
+    # comma separated list to run several chains in this process.
+    assert(len(sys.argv) in (4, 5))
     config_file = io.abspath2(sys.argv[1])
     param_name = sys.argv[2]
     sampler = sys.argv[3]
@@ -343,7 +620,11 @@ def main():
 
     config = io.load_config(config_file)
 
-    run_experiment(config, param_name, sampler)
+    if len(sys.argv) == 5:
+        chains = parse_chains(sys.argv[4])
+        run_experiment_logged(config, param_name, sampler, chains)
+    else:
+        run_experiment(config, param_name, sampler)
     print 'done'
 
 if __name__ == '__main__':
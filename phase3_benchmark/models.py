@@ -22,9 +22,9 @@ def mvn_logpdf_from_chol(X, mu, inv_chol_U_cov):
     return logpdf
 
 
-def logsumexp_explicit(x):
-    x_max = T.max(x)
-    Y = x_max + T.log(T.sum(T.exp(x - x_max)))
+def logsumexp_explicit(x, axis=None):
+    x_max = T.max(x, axis=axis, keepdims=True)
+    Y = T.max(x, axis=axis) + T.log(T.sum(T.exp(x - x_max), axis=axis))
     return Y
 
 
@@ -33,22 +33,47 @@ def outer_tt(x, y):
     return T.dot(T.shape_padright(x), T.shape_padleft(y))
 
 
+def mog_logpdf_from_chol(X, w, mus, inv_chol_U_covs):
+    '''Batched version of mvn_logpdf_from_chol() over mixture components.
+    Evaluates all K components with a single tensordot rather than building a
+    separate subgraph per component. Returns N vector of mixture logpdfs.'''
+    assert(X.ndim == 2)
+
+    # Assuming only X is Theano var so can do this in np only part
+    K, D = mus.shape
+    assert(w.shape == (K,))
+    assert(inv_chol_U_covs.shape == (K, D, D))
+    # This has overhead, but there is too much potential for confusion to skip
+    assert(np.allclose(inv_chol_U_covs, np.triu(inv_chol_U_covs)))
+    diags = np.diagonal(inv_chol_U_covs, axis1=1, axis2=2)  # K x D
+    log_det_cov = -2.0 * np.sum(np.log(diags), axis=1)  # K
+    log_part_func = D * np.log(2 * np.pi) + log_det_cov  # K
+    # Push the means through the factors up front: (x - mu) U = xU - muU
+    mu_U = np.einsum('kd,kde->ke', mus, inv_chol_U_covs)  # K x D
+    offset = np.log(w) - 0.5 * log_part_func  # K
+
+    # Theano part
+    X_U = T.tensordot(X, inv_chol_U_covs, axes=[[1], [1]])  # N x K x D
+    maha = T.sum(T.sqr(X_U - mu_U[None, :, :]), axis=2)  # N x K
+    loglik_mix = offset[None, :] - 0.5 * maha  # N x K
+    logpdf = logsumexp_explicit(loglik_mix, axis=1)  # N
+    return logpdf
+
+
 def MoG(x, params):
-    assert(x.ndim == 1)  # Assuming x is theano vector here
+    '''Works with x as theano vector (returns scalar) or N x D theano matrix
+    (returns N vector of logpdfs).'''
+    assert(x.ndim in (1, 2))
     assert(params['type'] == 'full')
 
     w = params['weights']
     w = w / np.sum(w)  # Just to be sure normalized
-    n_mixtures = len(w)
 
-    # Would this be an faster with scan??
-    loglik_mix = [None] * n_mixtures
-    for mm in xrange(n_mixtures):
-        mu = params['means'][mm, :]
-        PC = params['precisions_cholesky'][mm, :, :]
-        loglik_mix[mm] = mvn_logpdf_from_chol(T.shape_padleft(x), mu, PC)[0]
-    loglik_mix_T = T.log(w) + T.stack(loglik_mix, axis=0)
-    logpdf = logsumexp_explicit(loglik_mix_T)
+    X = T.shape_padleft(x) if x.ndim == 1 else x
+    logpdf = mog_logpdf_from_chol(X, w, params['means'],
+                                  params['precisions_cholesky'])
+    if x.ndim == 1:
+        logpdf = logpdf[0]
     return logpdf
 
 
@@ -59,13 +84,17 @@ def _MoG_sample(w, mus, covs, N=1):
 
     k = np.random.choice(n_mixtures, size=N, replace=True, p=w)
 
+    # Group draws by component so each cov gets factored only once and all of
+    # its rows come from one matrix product.
     X = np.zeros((N, D))
-    for nn, mm in enumerate(k):
-        # Note: This is not an efficient way to do it
-        mu, S = mus[mm, :], covs[mm, :, :]
-        X[nn, :] = np.random.multivariate_normal(mu, S)
+    for mm in np.unique(k):
+        idx = np.flatnonzero(k == mm)
+        mu, L = mus[mm, :], np.linalg.cholesky(covs[mm, :, :])
+        Z = np.random.randn(len(idx), D)
+        X[idx, :] = mu[None, :] + np.dot(Z, L.T)
     return X
 
+
 def MoG_sample(params, N=1):
     assert(params['type'] == 'full')
     X = _MoG_sample(params['weights'], params['means'], params['covariances'],
@@ -90,8 +119,15 @@ def IGN(x, params):
 
 
 def RNADE(x, params):
-    assert(x.ndim == 1)  # Assuming x is theano vector here
-    x = T.shape_padleft(x)  # 1 x V
+    '''Works with x as theano vector (returns scalar) or N x D theano matrix
+    (returns N vector of logpdfs).
+
+    Rather than unrolling a graph node per visible dim per ordering, all
+    orderings and dims are stacked: the hidden pre-activation at each position
+    is an exclusive cumsum of the contributions of the preceding dims, and the
+    per-dim output layers are evaluated with one batched dot.'''
+    assert(x.ndim in (1, 2))
+    X = T.shape_padleft(x) if x.ndim == 1 else x  # N x D
 
     # TODO infer these from parameters
     n_hidden, n_layers = params['n_hidden'], params['n_layers']
@@ -102,58 +138,62 @@ def RNADE(x, params):
     V_alpha, b_alpha = params['V_alpha'], params['b_alpha']
     V_mu, b_mu = params['V_mu'], params['b_mu']
     V_sigma, b_sigma = params['V_sigma'], params['b_sigma']
-    orderings = params['orderings']
-    D = len(orderings[0])
+    orderings = np.asarray(params['orderings'], dtype=int)  # O x D
+    O, D = orderings.shape
+    C = V_alpha.shape[2]
+    assert(V_alpha.shape == (D, n_hidden, C))
+    assert(all(sorted(curr_order) == range(D) for curr_order in orderings))
 
     assert(params['nonlinearity'] == 'RLU')  # Only one supported yet
     act_fun = T.nnet.relu
-    softmax = T.nnet.softmax
-    pl = T.shape_padleft
-    pr = T.shape_padright
-
-    N = x.shape[0]  # Should be 1 for now.
-
-    lp = []
-    for o_index, curr_order in enumerate(orderings):
-        assert(len(curr_order) == D)
-
-        a = T.zeros((N, n_hidden)) + pl(b1)  # N x H
-        lp_curr = []
-        for i in curr_order:
-            h = act_fun(a)  # N x H
-            for l in xrange(n_layers - 1):
-                h = act_fun(T.dot(h, Ws[l, :, :]) + pl(bs[l, :]))  # N x H
-
-            # All N x C
-            z_alpha = T.dot(h, V_alpha[i, :, :]) + pl(b_alpha[i, :])
-            z_mu = T.dot(h, V_mu[i, :, :]) + pl(b_mu[i, :])
-            z_sigma = T.dot(h, V_sigma[i, :, :]) + pl(b_sigma[i, :])
-
-            # Any final warping. All N x C.
-            # Alpha = T.exp(z_alpha) / T.sum(T.exp(z_alpha), axis=1, keepdims=True)
-            Alpha = softmax(z_alpha)
-            Mu = z_mu
-            Sigma = T.exp(z_sigma)  # TODO be explicit this is std
-
-            lp_components = -0.5 * ((Mu - pr(x[:, i])) / Sigma) ** 2 \
-                - T.log(Sigma) - 0.5 * T.log(2 * np.pi) + T.log(Alpha)  # N x C
-            lpc = logsumexp_explicit(lp_components)  # Assumes N=1!
-            lp_curr.append(lpc)
-
-            bias = pl(Wflags[i, :])
-            prod = outer_tt(x[:, i], W1[i, :])  # pl(x[0, i] * W1[i, 0])
-            update = prod + bias
-            a = a + update  # N x H
-        # The following only works with N=1!!
-        # lp.append(T.sum(lp_curr, axis=1) + T.log(1.0 / len(orderings)))
-        lp.append(T.sum(lp_curr) + T.log(1.0 / len(orderings)))
-    logpdf = logsumexp_explicit(lp)  # Assumes N=1!
-    return logpdf
 
+    # np part: put everything in ordering order, flattening (O, D) to O*D
+    P = np.zeros((D, O * D))  # Permutation matrices to reorder x, all O
+    P[orderings.ravel(), np.arange(O * D)] = 1.0
+    W1_o = W1[orderings, :]  # O x D x H
+    Wflags_o = Wflags[orderings, :]  # O x D x H
+    V_o = np.concatenate((V_alpha, V_mu, V_sigma), axis=2)  # D x H x 3C
+    V_o = np.reshape(V_o[orderings, :, :], (O * D, n_hidden, 3 * C))
+    b_o = np.concatenate((b_alpha, b_mu, b_sigma), axis=1)  # D x 3C
+    b_o = np.reshape(b_o[orderings, :], (O * D, 3 * C))
+
+    # Theano part
+    N = X.shape[0]
+    X_o = T.reshape(T.dot(X, P), (N, O, D))  # N x O x D
+    update = X_o[:, :, :, None] * W1_o[None, :, :, :] + Wflags_o[None, :, :, :]
+    # Exclusive cumsum: dim j only sees the dims before it in the ordering
+    a = T.cumsum(update, axis=2)[:, :, :-1, :]  # N x O x (D-1) x H
+    a = T.concatenate((T.zeros((N, O, 1, n_hidden)), a), axis=2)
+    a = a + b1[None, None, None, :]  # N x O x D x H
+
+    h = act_fun(a)
+    for l in xrange(n_layers - 1):
+        h = act_fun(T.tensordot(h, Ws[l, :, :], axes=[[3], [0]]) + bs[l, :])
+
+    # Put O*D in front as batch dim: (O*D) x N x H
+    h = T.reshape(h, (N, O * D, n_hidden)).dimshuffle(1, 0, 2)
+    z = T.batched_dot(h, V_o) + b_o[:, None, :]  # (O*D) x N x 3C
+    z_alpha, z_mu, z_sigma = z[:, :, :C], z[:, :, C:2 * C], z[:, :, 2 * C:]
+
+    # Any final warping. All (O*D) x N x C.
+    log_Alpha = z_alpha - T.shape_padright(logsumexp_explicit(z_alpha, axis=2))
+    Mu = z_mu
+    Sigma = T.exp(z_sigma)  # TODO be explicit this is std
+
+    x_o = T.reshape(X_o, (N, O * D)).T  # (O*D) x N
+    lp_components = -0.5 * ((Mu - T.shape_padright(x_o)) / Sigma) ** 2 \
+        - z_sigma - 0.5 * np.log(2 * np.pi) + log_Alpha
+    lpc = logsumexp_explicit(lp_components, axis=2)  # (O*D) x N
+    lp = T.sum(T.reshape(lpc, (O, D, N)), axis=1) + np.log(1.0 / O)  # O x N
+    logpdf = logsumexp_explicit(lp, axis=0)  # N
+    if x.ndim == 1:
+        logpdf = logpdf[0]
+    return logpdf
 
-def _RNADE_sample(params):
-    N = 1  # TODO generalize
 
+def _RNADE_sample(params, order_used, N=1):
+    '''Sample N points all using the same ordering. All N samples are advanced
+    through each dim together.'''
     n_hidden, n_layers = params['n_hidden'], params['n_layers']
 
     Wflags, W1, b1 = params['Wflags'], params['W1'], params['b1']
@@ -161,7 +201,6 @@ def _RNADE_sample(params):
     V_alpha, b_alpha = params['V_alpha'], params['b_alpha']
     V_mu, b_mu = params['V_mu'], params['b_mu']
     V_sigma, b_sigma = params['V_sigma'], params['b_sigma']
-    orderings = params['orderings']
 
     assert(params['nonlinearity'] == 'RLU')  # Only one supported yet
     act_fun = lambda x_: x_ * (x_ > 0.0)
@@ -175,36 +214,45 @@ def _RNADE_sample(params):
         R = e / np.sum(e, axis=1, keepdims=True)
         return R
 
-    o_index = np.random.choice(len(orderings))
-    order_used = orderings[o_index]
-
     X = np.zeros((N, len(order_used)))
     a = np.zeros((N, n_hidden)) + b1[None, :]  # N x H
+    rows = np.arange(N)
     for i in order_used:
         h = act_fun(a)  # N x H
         for l in xrange(n_layers - 1):
             h = act_fun(np.dot(h, Ws[l, :, :]) + bs[l, None])  # N x H
 
-            # All N x C
-            z_alpha = np.dot(h, V_alpha[i, :, :]) + b_alpha[i, None]
-            z_mu = np.dot(h, V_mu[i, :, :]) + b_mu[i, None]
-            z_sigma = np.dot(h, V_sigma[i, :, :]) + b_sigma[i, None]
+        # All N x C
+        z_alpha = np.dot(h, V_alpha[i, :, :]) + b_alpha[i, None]
+        z_mu = np.dot(h, V_mu[i, :, :]) + b_mu[i, None]
+        z_sigma = np.dot(h, V_sigma[i, :, :]) + b_sigma[i, None]
 
-            # Any final warping. All N x C.
-            Alpha = softmax(z_alpha)
-            Mu = z_mu
-            Sigma = np.exp(z_sigma)  # TODO be explicit this is std
+        # Any final warping. All N x C.
+        Alpha = softmax(z_alpha)
+        Mu = z_mu
+        Sigma = np.exp(z_sigma)  # TODO be explicit this is std
 
-            # TODO generalize to N > 1, move to subroutine
-            k = np.random.choice(Alpha.shape[1], p=Alpha[0, :])
-            X[0, i] = Mu[0, k] + Sigma[0, k] * np.random.randn()
+        # Pick a component for every row at once by inverse-CDF
+        u = np.random.rand(N, 1)
+        k = np.sum(np.cumsum(Alpha, axis=1) < u, axis=1)
+        k = np.minimum(k, Alpha.shape[1] - 1)  # In case of round off in cumsum
+        X[:, i] = Mu[rows, k] + Sigma[rows, k] * np.random.randn(N)
 
-            a += np.outer(X[:, i], W1[i, :]) + Wflags[i, None]  # N x H
+        a += np.outer(X[:, i], W1[i, :]) + Wflags[i, None]  # N x H
     return X
 
 
 def RNADE_sample(params, N=1):
-    X = np.concatenate([_RNADE_sample(params) for _ in xrange(N)], axis=0)
+    orderings = params['orderings']
+    D = len(orderings[0])
+
+    o_index = np.random.choice(len(orderings), size=N, replace=True)
+
+    # Group by ordering so each group is one batched pass over the dims
+    X = np.zeros((N, D))
+    for oo in np.unique(o_index):
+        idx = np.flatnonzero(o_index == oo)
+        X[idx, :] = _RNADE_sample(params, orderings[oo], N=len(idx))
     return X
 
 BUILD_MODEL = {'MoG': MoG, 'VBMoG': MoG, 'RNADE': RNADE}
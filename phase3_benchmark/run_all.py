@@ -1,13 +1,59 @@
 # Ryan Turner (turnerry@iro.umontreal.ca)
+import os
 import sys
+from multiprocessing import Pool
 from time import time
+import numpy as np
 import fileio as io
-from main import run_experiment
+import ledger
+from main import run_experiment_logged
 # This will import pymc3 which is not needed if the experiments are run in a
 # separate process in the future. Loading pymc3 will be a bit of a waste just
 # to get the dictionary keys. We could re-work this, but prob not worth effort.
 from samplers import BUILD_STEP_PM, BUILD_STEP_MC
 
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def set_blas_threads(n_threads):
+    '''Pin BLAS threads in this process, used as the pool initializer. numpy is
+    already loaded by now so the env vars only reach child processes, but MKL
+    can still be changed at runtime.'''
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        import mkl
+        mkl.set_num_threads(n_threads)
+    except ImportError:
+        print 'mkl-service not found, BLAS threads not pinned'
+
+
+def run_experiment_safe(args):
+    '''Wrapper to run in pool that prints failures rather than killing the
+    whole sweep.'''
+    config, model_name, sampler, chains = args
+
+    # Forked workers would otherwise all share the parent's RNG state
+    np.random.seed()
+
+    t = time()
+    success = True
+    try:
+        run_experiment_logged(config, model_name, sampler, chains)
+    except Exception as err:
+        print '%s/%s failed' % (model_name, sampler)
+        print str(err)
+        success = False
+    print 'wall time %fs' % (time() - t)
+    return success
+
+
+def group_chains(chains, chains_per_job):
+    '''Split list of chain numbers into consecutive groups, one per job.'''
+    groups = [chains[ii:ii + chains_per_job]
+              for ii in xrange(0, len(chains), chains_per_job)]
+    return groups
+
 
 def main():
     num_args = len(sys.argv) - 1
@@ -20,6 +66,8 @@ def main():
     config_file = io.abspath2(config_path)
 
     config = io.load_config(config_file)
+    njobs = config['njobs']
+    assert(njobs >= 1)
 
     model_list = io.get_model_list(config['input_path'], config['pkl_ext'])
     # model_list = model_list[:5]  # TODO remove, test only
@@ -33,22 +81,59 @@ def main():
     print sampler_list
 
     # Get the exact samples
-    for model_name in model_list:
-        run_experiment(config, model_name, config['exact_name'])
+    exact_chains = [(model_name, config['exact_name'], 0)
+                    for model_name in model_list]
 
     # Run n_chains in the outer loop since if process get killed we have less
     # chains but with even distribution over models and samplers.
-    for model_name in model_list:
-        for _ in xrange(config['n_chains']):
-            # TODO could put ADVI init here to keep it fixed across samplers
-            for sampler in sampler_list:
-                t = time()
-                try:
-                    run_experiment(config, model_name, sampler)
-                except Exception as err:
-                    print '%s/%s failed' % (model_name, sampler)
-                    print str(err)
-                print 'wall time %fs' % (time() - t)
+    # TODO could put ADVI init here to keep it fixed across samplers
+    chains = [(model_name, sampler, ii)
+              for model_name in model_list
+              for ii in xrange(config['n_chains'])
+              for sampler in sampler_list]
+
+    # The ledger is kept per chain, so resume works whatever chains_per_job
+    ledger_file = ledger.get_ledger_file(config['output_path'])
+    if config['resume']:
+        job_status = ledger.load_status(ledger_file)
+        todo = lambda args: not ledger.is_done(job_status,
+                                               ledger.job_name(*args))
+        exact_chains = filter(todo, exact_chains)
+        n_total = len(chains)
+        chains = filter(todo, chains)
+        print 'resuming, skipping %d / %d completed chains' % \
+            (n_total - len(chains), n_total)
+    for args in exact_chains + chains:
+        ledger.record(ledger_file, ledger.job_name(*args), ledger.PLANNED)
+
+    exact_jobs = [(config, model_name, sampler, [ii])
+                  for model_name, sampler, ii in exact_chains]
+    # Group the remaining chains of each model and sampler into jobs, in order
+    # of their first chain so the chain-outer ordering is kept.
+    chains_by_case = {}
+    for model_name, sampler, ii in chains:
+        chains_by_case.setdefault((model_name, sampler), []).append(ii)
+    jobs = [(config, model_name, sampler, group)
+            for (model_name, sampler), case_chains in chains_by_case.items()
+            for group in group_chains(case_chains, config['chains_per_job'])]
+    order = dict((args, nn) for nn, args in enumerate(chains))
+    jobs.sort(key=lambda args: order[(args[1], args[2], args[3][0])])
+
+    print 'running %d jobs with %d workers' % (len(jobs), njobs)
+    if njobs == 1:  # Keep it all in one process, easier to debug
+        set_blas_threads(config['num_cores_per_job'])
+        status = map(run_experiment_safe, exact_jobs + jobs)
+    else:
+        pool = Pool(njobs, initializer=set_blas_threads,
+                    initargs=(config['num_cores_per_job'],))
+        # Exact samples first so they are done even if sweep is killed
+        status = pool.map(run_experiment_safe, exact_jobs, chunksize=1)
+        # imap with chunksize=1 dispatches in list order, preserving the
+        # chain-outer ordering from above.
+        status += list(pool.imap(run_experiment_safe, jobs, chunksize=1))
+        pool.close()
+        pool.join()
+    print '%d / %d jobs failed' % (len(status) - sum(status), len(status))
     print 'done'
 
 if __name__ == '__main__':
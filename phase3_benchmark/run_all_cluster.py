@@ -3,7 +3,9 @@ import sys
 from time import time
 import numpy as np
 import fileio as io
-from main import run_experiment
+import ledger
+from main import run_experiment_logged
+from run_all import group_chains
 import os
 from clusterlib.scheduler import submit, queued_or_running_jobs
 # This will import pymc3 which is not needed if the experiments are run in a
@@ -41,25 +43,58 @@ def main():
     # Run n_chains in the outer loop since if process get killed we have less
     # chains but with even distribution over models and samplers.
     scheduled_jobs = set(queued_or_running_jobs())
+    ledger_file = ledger.get_ledger_file(config['output_path'])
+    job_status = ledger.load_status(ledger_file) if config['resume'] else {}
     for model_name in model_list:
         # Get the exact samples
-        run_experiment(config, model_name, config['exact_name'])
+        job = ledger.job_name(model_name, config['exact_name'], 0)
+        if ledger.is_done(job_status, job):
+            print '%s already completed, skipping' % job
+        else:
+            run_experiment_logged(config, model_name, config['exact_name'],
+                                  [0])
 
-        # Get the sampler samples
-        for i in xrange(config['n_chains']):
-            # TODO could put ADVI init here to keep it fixed across samplers
-            for sampler in sampler_list:
-                t = time()
-                job_name = "slurm-%s-%s-%d" % (model_name, sampler, i)
-                cmd_line_args = (config_file, model_name, sampler)
-                if job_name in scheduled_jobs:
-                    print '%s already in scheduled jobs, but running anyway' % job_name
-                options = "-c 1 --job-name=%s -t 45:00 --mem=32gb --output %s.out" % (job_name, job_name)
-                end = "slurm_job_main.sh %s %s %s" % cmd_line_args
-                command = "sbatch %s %s" % (options, end) 
-                print 'Executing:', command
-                os.system(command)
-                print 'wall time %fs' % (time() - t)
+        # Get the sampler samples, with up to chains_per_job chains of the
+        # same sampler in each job so they share loading and compiling.
+        jobs = []
+        for sampler in sampler_list:
+            chains = []
+            for i in xrange(config['n_chains']):
+                job = ledger.job_name(model_name, sampler, i)
+                if ledger.is_done(job_status, job):
+                    print '%s already completed, skipping' % job
+                    continue
+                chains.append(i)
+            for group in group_chains(chains, config['chains_per_job']):
+                jobs.append((group, sampler))
+        # Keep the chain-outer order over samplers
+        jobs.sort(key=lambda job: (job[0][0], job[1]))
+
+        # TODO could put ADVI init here to keep it fixed across samplers
+        for chains, sampler in jobs:
+            t = time()
+            chains_str = ','.join(str(i) for i in chains)
+            job_name = "slurm-%s-%s-%s" % \
+                (model_name, sampler, '-'.join(str(i) for i in chains))
+            cmd_line_args = (config_file, model_name, sampler, chains_str)
+            if job_name in scheduled_jobs:
+                if config['resume']:
+                    print '%s already in scheduled jobs, skipping' % job_name
+                    continue
+                print '%s already in scheduled jobs, but running anyway' % \
+                    job_name
+            for i in chains:
+                job = ledger.job_name(model_name, sampler, i)
+                ledger.record(ledger_file, job, ledger.PLANNED)
+            # Chains run one after another so scale the time limit
+            options = "-c 1 --job-name=%s -t %d:00 --mem=32gb" % \
+                (job_name, 45 * len(chains))
+            options += " --output %s.out" % job_name
+            end = "slurm_job_main.sh %s %s %s %s" % cmd_line_args
+            command = "sbatch %s %s" % (options, end)
+            print 'Executing:', command
+            os.system(command)
+            print 'wall time %fs' % (time() - t)
     print 'done'
 
 if __name__ == '__main__':
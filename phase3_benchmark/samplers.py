@@ -54,6 +54,28 @@ def slice_default(step_kwds):
     step_kwds['iter_limit'] = 10 ** 6
     return pm.Slice(**step_kwds)
 
+
+class VectorizedMap(object):
+    '''Stand in for a pool so emcee gets the logpdf of all the walkers it
+    proposes in one call, since emcee 2 has no vectorize option. emcee calls
+    pool.map(f, list of points) where f just wraps lnpostfn, so skip it.'''
+
+    def __init__(self, logpdf_vec):
+        self.logpdf_vec = logpdf_vec
+
+    def map(self, f, X):
+        logpdf = self.logpdf_vec(np.asarray(X))
+        assert(logpdf.shape == (len(X),))
+        return logpdf
+
+
+def emcee_vectorized(n_walkers, D, logpdf_vec):
+    '''logpdf_vec takes N x D array and returns N vector of logpdfs.'''
+    sampler = EnsembleSampler(n_walkers, D, logpdf_vec,
+                              pool=VectorizedMap(logpdf_vec))
+    return sampler
+
+
 BUILD_STEP_PM = {'NUTS-default': NUTS,
                  'Metro-default': metro_default,
                  'Cauchy-proposal': cauchy,
@@ -62,6 +84,7 @@ BUILD_STEP_PM = {'NUTS-default': NUTS,
                  'HMC-default': HMC,
                  'slice-default': slice_default}
 
-BUILD_STEP_MC = {'emcee': EnsembleSampler}
+# These take a vectorized logpdf
+BUILD_STEP_MC = {'emcee': emcee_vectorized}
 
 assert(set(BUILD_STEP_PM.keys()).isdisjoint(BUILD_STEP_MC.keys()))
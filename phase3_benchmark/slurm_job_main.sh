@@ -6,4 +6,4 @@ export PYTHONUNBUFFERED=1
 echo Running on $HOSTNAME
 
 source activate samp-phase3
-python main.py $1 $2 $3
+python main.py $1 $2 $3 $4
@@ -0,0 +1,133 @@
+# Ryan Turner (turnerry@iro.umontreal.ca)
+import os
+import shutil
+import numpy as np
+import fileio as io
+
+BLOCK_SIZE = 10 ** 4  # Max rows of samples held in memory
+RAW_EXT = '.part'  # Not chain_ext so phase 4 never picks it up
+TMP_EXT = io.TMP_EXT  # Name atomic_write() uses on the way to fname
+DTYPE = np.float64
+
+
+class TraceWriter(object):
+    '''Append samples to disk as they come in, so memory use is bounded by
+    block_size rows no matter how long the chain is. Rows go to a raw binary
+    file next to fname until close() writes fname in chain_format, so fname
+    only shows up once it is complete.'''
+
+    def __init__(self, fname, D, chain_format, block_size=BLOCK_SIZE):
+        assert(os.path.isabs(fname))
+        assert(chain_format in io.CHAIN_FORMATS)
+        assert(D >= 1 and block_size >= 1)
+        self.fname, self.D, self.chain_format = fname, D, chain_format
+        self.raw_fname = fname + RAW_EXT
+        self.raw_f = open(self.raw_fname, 'wb')
+        self.buf = np.zeros((block_size, D), dtype=DTYPE)
+        self.n_buf = 0  # Rows in buf not yet on disk
+        self.n_disk = 0  # Rows in raw file
+
+    def __len__(self):
+        return self.n_disk + self.n_buf
+
+    def append(self, x):
+        '''Add one sample, called every iteration so keep it cheap.'''
+        self.buf[self.n_buf, :] = x
+        self.n_buf += 1
+        if self.n_buf == self.buf.shape[0]:
+            self.flush()
+
+    def extend(self, X):
+        '''Add a block of samples.'''
+        assert(np.ndim(X) == 2 and X.shape[1] == self.D)
+        self.flush()
+        np.asarray(X, dtype=DTYPE).tofile(self.raw_f)
+        self.n_disk += X.shape[0]
+
+    def flush(self):
+        self.buf[:self.n_buf, :].tofile(self.raw_f)
+        self.n_disk += self.n_buf
+        self.n_buf = 0
+        self.raw_f.flush()
+
+    def truncate(self, N):
+        '''Drop all samples after the first N.'''
+        assert(0 <= N <= len(self))
+        self.flush()
+        self.raw_f.truncate(N * self.D * self.buf.itemsize)
+        self.raw_f.seek(0, os.SEEK_END)
+        self.n_disk = N
+
+    def view(self):
+        '''Read only memory-map of all samples so far, does not load them.'''
+        self.flush()
+        if self.n_disk == 0:  # Can not memory-map empty file
+            return np.zeros((0, self.D), dtype=DTYPE)
+        X = np.memmap(self.raw_fname, dtype=DTYPE, mode='r',
+                      shape=(self.n_disk, self.D))
+        return X
+
+    def discard(self):
+        '''Throw away all samples, and the chain file if close() already wrote
+        it, so a failed run leaves nothing behind.'''
+        self.raw_f.close()
+        for fname in (self.raw_fname, self.fname + TMP_EXT, self.fname):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def close(self):
+        '''Write the final chain file, streaming from the raw file in blocks,
+        and remove the raw file.'''
+        self.flush()
+        self.raw_f.close()
+        shape = (self.n_disk, self.D)
+        if self.chain_format == 'npy':
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(DTYPE)),
+                      'fortran_order': False, 'shape': shape}
+            with io.atomic_write(self.fname) as f, \
+                    open(self.raw_fname, 'rb') as f_raw:
+                np.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(f_raw, f)
+        else:
+            block_size = self.buf.shape[0]
+            X = np.zeros(shape) if self.n_disk == 0 else \
+                np.memmap(self.raw_fname, dtype=DTYPE, mode='r', shape=shape)
+            with io.atomic_write(self.fname) as f:
+                for start in xrange(0, self.n_disk, block_size):
+                    np.savetxt(f, X[start:start + block_size, :],
+                               delimiter=',')
+            del X
+        os.remove(self.raw_fname)
+
+
+class NullWriter(TraceWriter):
+    '''Same append() as TraceWriter, but full blocks are dropped rather than
+    written to disk, for timing the harness without filling the disk.'''
+
+    def __init__(self, D, block_size=BLOCK_SIZE):
+        assert(D >= 1 and block_size >= 1)
+        self.D = D
+        self.buf = np.zeros((block_size, D), dtype=DTYPE)
+        self.n_buf = 0
+        self.n_disk = 0  # Rows dropped
+
+    def flush(self):
+        self.n_disk += self.n_buf
+        self.n_buf = 0
+
+
+def temp_writer(dir_, prefix, ext, D, chain_format):
+    '''Get TraceWriter for a new unique chain file name in dir_. The name is
+    reserved by creating the raw file, not the chain file itself, so it is not
+    seen by phase 4 until the writer is closed.'''
+    raw_fname = io.get_temp_filename(dir_, prefix, ext + RAW_EXT)
+    writer = TraceWriter(io.chomp(raw_fname, RAW_EXT), D, chain_format)
+    return writer
+
+
+def record_gen(input_gen, writer, get_row):
+    '''Pass through input_gen, appending get_row(item) of every item to
+    writer on the way.'''
+    for item in input_gen:
+        writer.append(get_row(item))
+        yield item
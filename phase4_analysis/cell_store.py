@@ -0,0 +1,42 @@
+# Ryan Turner (turnerry@iro.umontreal.ca)
+import cPickle as pkl
+import os
+import fileio as io
+
+
+def cell_key(input_path, exact_fname, file_list, meta_ext, metrics, n_grid):
+    '''Results of a sampler x example cell only depend on these inputs, so if
+    none of them change we can reuse the stored results.'''
+    files = [exact_fname] + [ff + ext for ff in sorted(file_list)
+                             for ext in ('', meta_ext)]
+    stamps = tuple((ff, io.file_stamp(os.path.join(input_path, ff)))
+                   for ff in files)
+    key = (stamps, tuple(sorted(metrics)), n_grid)
+    return key
+
+
+def get_cell_file(store_path, sampler, example, ext='.pkl', sep='_'):
+    fname = os.path.join(store_path, example + sep + sampler + ext)
+    assert(os.path.isabs(fname))
+    return fname
+
+
+def load_cell(store_path, sampler, example, key):
+    '''Returns None if cell is not in store or the inputs have changed.'''
+    fname = get_cell_file(store_path, sampler, example)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'rb') as f:
+        stored_key, cell = pkl.load(f)
+    if stored_key != key:
+        print 'stale %s' % fname
+        return None
+    print 'loaded %s' % fname
+    return cell
+
+
+def save_cell(store_path, sampler, example, key, cell):
+    io.makedirs_safe(store_path)
+    fname = get_cell_file(store_path, sampler, example)
+    with io.atomic_write(fname) as f:
+        pkl.dump((key, cell), f, pkl.HIGHEST_PROTOCOL)
@@ -1,7 +1,6 @@
 # Ryan Turner (turnerry@iro.umontreal.ca)
 import numpy as np
 import scipy.stats as ss
-import pymc3 as pm
 
 MIN_ESS_PER_CHAIN = 1.0
 
@@ -13,95 +12,335 @@ def summaries(x):
     return D
 
 
-def geweke(chains, max_intervals=20):
+def geweke_windows(N, max_intervals=20, first=0.1, last=0.5):
+    '''Get the (first start, first stop, last start) indices of the windows
+    pm.diagnostics.geweke() would compare for a chain of length N. The last
+    window always runs to N.'''
+    assert(0.0 < first and 0.0 < last and first + last < 1.0)
+
+    # Will this formula never lead to too many intervals??
+    intervals = min(max_intervals, N // 10) + 1
+
+    # Same start indices as pymc3
+    end = N - 1
+    last_start_idx = (1.0 - last) * end
+    step = max(1, int(last_start_idx / max(1, intervals - 1)))
+    start_indices = np.arange(0, int(last_start_idx), step=step)
+
+    windows = [(start, start + int(first * (end - start)),
+                int(end - last * (end - start))) for start in start_indices]
+    return windows, intervals
+
+
+def geweke(chains, max_intervals=20, first=0.1, last=0.5):
+    '''Same z-scores as pm.diagnostics.geweke() but done for all chains and
+    dims at once, so we do not need pymc3 in phase 4.'''
     n_chains, N, D = chains.shape
-    scores = np.zeros((n_chains, D))
-    for nn in xrange(n_chains):
-        for ii in xrange(D):
-            # Will this formula never lead to too many intervals??
-            intervals = min(max_intervals, N // 10) + 1
-            R = pm.diagnostics.geweke(chains[nn, :, ii], intervals=intervals)
-            # assert(R.shape[0] == intervals)
-            # multiply by sqrt so expected to follow normal
-            # Could also try corrected min p-value
-            scores[nn, ii] = np.mean(R[:, 1]) * np.sqrt(intervals)
+    windows, intervals = geweke_windows(N, max_intervals, first, last)
+
+    # pymc3 uses ddof=0 var here
+    z = np.zeros((len(windows), n_chains, D))
+    for ii, (start, stop, last_start) in enumerate(windows):
+        first_slice = chains[:, start:stop, :]
+        last_slice = chains[:, last_start:, :]
+        z[ii, :, :] = (np.mean(first_slice, axis=1) -
+                       np.mean(last_slice, axis=1)) / \
+            np.sqrt(np.var(first_slice, axis=1) + np.var(last_slice, axis=1))
+
+    # multiply by sqrt so expected to follow normal
+    # Could also try corrected min p-value
+    scores = np.mean(z, axis=0) * np.sqrt(intervals)
     scores = np.mean(scores, axis=0) * np.sqrt(n_chains)
     return scores
 
 
 def gelman_rubin(chains):
     n_chains, num_samples, D = chains.shape
-    Rhat = np.zeros(D)
-    for ii in xrange(D):
-        x = chains[:, :, ii]
+    if n_chains < 2:  # Not defined with one chain
+        return np.nan + np.zeros(D)
 
-        # Calculate between-chain variance
-        B = num_samples * np.var(np.mean(x, axis=1), axis=0, ddof=1)
+    Vhat, W = between_within_var(chains)
+    Rhat = np.sqrt(Vhat / W)
+    return Rhat
 
-        # Calculate within-chain variance
-        W = np.mean(np.var(x, axis=1, ddof=1), axis=0)
 
-        # Estimate of marginal posterior variance
-        Vhat = W * (num_samples - 1) / num_samples + B / num_samples
+def between_within_var_from_moments(chain_mean, chain_var, num_samples):
+    '''Same as between_within_var() but from n_chains x D arrays of each
+    chain's mean and unbiased var.'''
+    n_chains, D = chain_mean.shape
 
-        Rhat[ii] = np.sqrt(Vhat / W)
-    return Rhat
+    # Calculate between-chain variance, no info on this with one chain
+    B = np.zeros(D)
+    if n_chains > 1:
+        B = num_samples * np.var(chain_mean, axis=0, ddof=1)
 
+    # Calculate within-chain variance
+    W = np.mean(chain_var, axis=0)
 
-def effective_n(chains):
-    n_chains, num_samples, D = chains.shape
+    # Estimate of marginal posterior variance
+    Vhat = W * (num_samples - 1) / num_samples + B / num_samples
+    return Vhat, W
 
-    def get_vhat(x):
-        # TODO eliminate repetition with gelman rubin
-        num_samples = x.shape[1]
 
-        # Calculate between-chain variance
-        B = num_samples * np.var(np.mean(x, axis=1), axis=0, ddof=1)
+def between_within_var(chains):
+    '''Get marginal posterior var estimate Vhat and within-chain var W for
+    all dims at once.'''
+    num_samples = chains.shape[1]
+    Vhat, W = between_within_var_from_moments(
+        np.mean(chains, axis=1), np.var(chains, axis=1, ddof=1), num_samples)
+    return Vhat, W
 
-        # Calculate within-chain variance
-        W = np.mean(np.var(x, axis=1, ddof=1), axis=0)
 
-        # Estimate of marginal posterior variance
-        Vhat = W * (num_samples - 1) / num_samples + B / num_samples
+def autocov_fft(x):
+    '''Biased (denominator N) autocovariance of x along axis 1, at all lags,
+    using FFT. Zero pad to avoid circular wrap around.'''
+    num_samples = x.shape[1]
+    n_fft = 2 ** int(np.ceil(np.log2(2 * num_samples)))
 
-        return Vhat
+    x = x - np.mean(x, axis=1, keepdims=True)
+    F = np.fft.rfft(x, n=n_fft, axis=1)
+    acov = np.fft.irfft(F * np.conj(F), n=n_fft, axis=1)[:, :num_samples]
+    acov = acov / num_samples
+    return acov
 
-    def get_neff(x, Vhat, inc_frac=1.05):
-        num_chains, num_samples = x.shape
 
-        negative_autocorr = False
-        t = 1
+def geyer_ess(rho, n_chains, num_samples, truncated=False):
+    '''ESS from autocorrelations rho (lags x D) with Geyer's initial monotone
+    sequence truncation, as in Stan. Use truncated if rho stops short of the
+    chain length, then ESS is nan where the sequence has not ended within rho
+    since the sum would be cut short and overestimate ESS.'''
+    # Geyer: sum consecutive pairs, stop at first non-positive pair, and make
+    # the sequence monotone (non-increasing) up to there.
+    n_pairs = rho.shape[0] // 2
+    P = rho[0:2 * n_pairs:2, :] + rho[1:2 * n_pairs:2, :]
+    valid = np.cumprod(P > 0.0, axis=0).astype(bool)
+    P = np.minimum.accumulate(P, axis=0)
+    tau = -1.0 + 2.0 * np.sum(P * valid, axis=0)
 
-        rho = np.ones(num_samples)
-        # Iterate until the sum of consecutive estimates of autocor is neg.
-        # TODO emcee uses FFT to estimate this for speed. Look into it.
-        while not negative_autocorr and (t < num_samples):
-            variogram = np.mean((x[:, t:] - x[:, :-t]) ** 2)
-            rho[t] = 1.0 - variogram / (2.0 * Vhat)
-            negative_autocorr = np.sum(rho[t - 1:t + 1]) < 0
-            # original was t += 1, but that just gets too slow
-            t_new = int(np.ceil(t * inc_frac))
-            assert(t_new > t)  # prevent infinite loop
-            t = t_new
+    n_total = n_chains * num_samples + 0.0
+    # Give up and use n_total if tau is degenerate
+    n_eff = np.where(tau > 0.0, n_total / np.maximum(tau, 1e-12), n_total)
+    # If we want to cap it:
+    n_eff = np.minimum(n_total, n_eff)
+    n_eff = np.maximum(MIN_ESS_PER_CHAIN * n_chains, n_eff)
+    if truncated:
+        ended = ~valid[-1, :] if n_pairs > 0 else np.zeros(rho.shape[1], bool)
+        n_eff = np.where(ended, n_eff, np.nan)
+    return n_eff
 
-        # TODO comment
-        if t % 2:
-            t -= 1
 
-        n_eff = num_chains * num_samples / (1.0 + 2 * rho[1:t - 1].sum())
-        # If we want to cap it:
-        n_eff = min(num_chains * num_samples + 0.0, n_eff)
-        return n_eff
+def effective_n(chains, block_size=10 ** 7):
+    '''Multi-chain ESS using all autocorrelations from FFT with Geyer's
+    initial monotone sequence truncation, as in Stan. chains can also be a
+    list of equal length (possibly memory-mapped) 2D views, only a block of
+    dims from every chain is pulled into memory at once.'''
+    n_chains = len(chains)
+    num_samples, D = chains[0].shape
+    assert(all(x.shape == (num_samples, D) for x in chains))
 
+    # Do dims in blocks to bound memory of FFT
     n_eff = np.zeros(D)
-    for ii in xrange(D):
-        x = chains[:, :, ii]
-
-        Vhat = get_vhat(x)
-        n_eff[ii] = get_neff(x, Vhat)
-    n_eff = np.maximum(MIN_ESS_PER_CHAIN * n_chains, n_eff)
+    dims_per_block = max(1, block_size // (n_chains * num_samples))
+    for start in xrange(0, D, dims_per_block):
+        idx = slice(start, start + dims_per_block)
+        x = np.stack([chain[:, idx] for chain in chains], axis=0)
+        Vhat, W = between_within_var(x)
+        acov = np.mean(autocov_fft(x), axis=0)
+        rho = 1.0 - (W[None, :] - acov) / Vhat[None, :]
+        rho[0, :] = 1.0
+        n_eff[idx] = geyer_ess(rho, n_chains, num_samples)
     return n_eff
 
+
+def lagged_products(z, prev, max_lag):
+    '''Get sum_t z[t] * y[t - k] for lags k < max_lag, where y is z with the
+    rows prev prepended, using FFT. z is new rows, prev the ones before.'''
+    n_prev = prev.shape[0]
+    y = np.concatenate((prev, z), axis=0)
+    z_pad = np.concatenate((np.zeros_like(prev), z), axis=0)
+    # Enough padding that negative lags do not wrap around onto y
+    n_fft = 2 ** int(np.ceil(np.log2(y.shape[0] + max_lag)))
+    F_z = np.fft.rfft(z_pad, n=n_fft, axis=0)
+    F_y = np.fft.rfft(y, n=n_fft, axis=0)
+    prods = np.fft.irfft(F_z * np.conj(F_y), n=n_fft, axis=0)[:max_lag, :]
+    assert(n_prev <= max_lag)
+    return prods
+
+
+def prefix_chain_stats(chain, all_n, positions, max_lag, block_size):
+    '''One pass over chain to get the stats needed by prefix_diagnostics()
+    for chain[:n, :] for every n in all_n, plus running sums at positions.
+    Blocks are only split at all_n, the sums at positions inside a block come
+    from cumsums over it.'''
+    D = chain.shape[1]
+    n_grid = len(all_n)
+    assert(max_lag >= 2)
+
+    # Everything is done on chain shifted by its first row, which avoids
+    # cancellation in sums of squares without changing any of the stats.
+    shift = chain[0, :] if chain.shape[0] > 0 else np.zeros(D)
+
+    mu_all = np.zeros((n_grid, D))
+    var_all = np.zeros((n_grid, D))
+    acov_all = np.zeros((n_grid, max_lag, D))
+    sums = {}
+    positions = sorted(positions)
+    pos_idx = 0
+    while pos_idx < len(positions) and positions[pos_idx] <= 0:
+        sums[positions[pos_idx]] = (0, np.zeros(D), np.zeros(D))
+        pos_idx += 1
+
+    count = 0
+    sum1, sum2 = np.zeros(D), np.zeros(D)
+    lag_sum = np.zeros((max_lag, D))  # sum_t z[t] z[t + k]
+    head_sum = np.zeros((max_lag + 1, D))  # sum of first k rows
+    tail = np.zeros((0, D))  # last max_lag - 1 rows, for lag products
+    grid_idx = 0
+    for target in sorted(set(all_n)):
+        while count < min(target, chain.shape[0]):
+            stop = min(target, count + block_size)
+            z = chain[count:stop, :] - shift
+            n_block = z.shape[0]
+
+            # Running sums at any of positions that fall in this block
+            pos_block = []
+            while pos_idx < len(positions) and positions[pos_idx] <= stop:
+                pos_block.append(positions[pos_idx])
+                pos_idx += 1
+            if len(pos_block) > 0:
+                idx = np.array(pos_block) - count - 1
+                cum1 = sum1 + np.cumsum(z, axis=0)[idx, :]
+                cum2 = sum2 + np.cumsum(z ** 2, axis=0)[idx, :]
+                for jj, pos in enumerate(pos_block):
+                    sums[pos] = (pos, cum1[jj, :], cum2[jj, :])
+
+            if count < max_lag:
+                n_head = min(max_lag - count, n_block)
+                head_sum[count + 1:count + n_head + 1, :] = \
+                    sum1 + np.cumsum(z[:n_head, :], axis=0)
+            lag_sum += lagged_products(z, tail, max_lag)
+            tail = np.concatenate((tail, z), axis=0)[-(max_lag - 1):, :]
+            sum1 = sum1 + np.sum(z, axis=0)
+            sum2 = sum2 + np.sum(z ** 2, axis=0)
+            count = stop
+        while grid_idx < n_grid and all_n[grid_idx] == target:
+            if count < 2:  # Too short, leave as nan
+                mu_all[grid_idx, :] = np.nan
+                var_all[grid_idx, :] = np.nan
+                acov_all[grid_idx, :, :] = np.nan
+                grid_idx += 1
+                continue
+
+            n = float(count)
+            m = sum1 / n
+            mu_all[grid_idx, :] = m + shift
+            var_all[grid_idx, :] = (sum2 - n * m ** 2) / (n - 1.0)
+
+            # Autocov about prefix mean from the running sums, see
+            # autocov_fft() for the batch version.
+            n_lags = min(max_lag, count)
+            lags = np.arange(n_lags)
+            # Sum of last k rows, for k < n_lags
+            tail_sum = np.zeros((n_lags, D))
+            tail_sum[1:, :] = np.cumsum(tail[::-1, :], axis=0)[:n_lags - 1, :]
+            sum_start = sum1[None, :] - tail_sum  # sum_{t < n - k} z[t]
+            sum_end = sum1[None, :] - head_sum[:n_lags, :]  # sum_{t >= k}
+            acov = lag_sum[:n_lags, :] - m[None, :] * (sum_start + sum_end) + \
+                (n - lags[:, None]) * m[None, :] ** 2
+            acov_all[grid_idx, :n_lags, :] = acov / n
+            grid_idx += 1
+    assert(grid_idx == n_grid)
+    # Positions past the end of chain just get the totals
+    for pos in positions[pos_idx:]:
+        sums[pos] = (count, sum1, sum2)
+    return mu_all, var_all, acov_all, sums, shift
+
+
+def prefix_diagnostics(all_chains, all_n, max_lag=2 ** 10,
+                       block_size=10 ** 4, max_intervals=20):
+    '''Get STD_DIAGNOSTICS at every grid point, using the first n samples of
+    every chain for each n in all_n, with one pass over each chain.
+
+    R-hat is exact. Geweke is exact since the window sums are saved as the
+    pass goes by them. ESS only uses lags < max_lag, so it is nan for chains
+    that still have autocorrelation at that lag rather than overestimated.
+    Chains shorter than all_n[-1] clip all_n to the shortest chain, like
+    prefix_moments() does.'''
+    n_chains = len(all_chains)
+    assert(n_chains >= 1)
+    D = all_chains[0].shape[1]
+    assert(all(np.ndim(x) == 2 and x.shape[1] == D for x in all_chains))
+    n_grid, = np.shape(all_n)
+    assert(np.all(np.diff(all_n) >= 0))
+    min_len = min(x.shape[0] for x in all_chains)
+    if min_len < all_n[-1]:
+        print 'warning chains too short for all_n, %d < %d' % \
+            (min_len, all_n[-1])
+        all_n = np.minimum(all_n, min_len)
+
+    all_windows = [geweke_windows(n, max_intervals) for n in all_n]
+    positions = set(all_n)
+    for windows, _ in all_windows:
+        for start, stop, last_start in windows:
+            positions.update((start, stop, last_start))
+
+    mu = np.zeros((n_chains, n_grid, D))
+    var = np.zeros((n_chains, n_grid, D))
+    acov = np.zeros((n_grid, max_lag, D))
+    z_geweke = np.zeros((n_chains, n_grid, D))
+    for c_num, chain in enumerate(all_chains):
+        R = prefix_chain_stats(chain, all_n, positions, max_lag, block_size)
+        mu[c_num], var[c_num], acov_curr, sums, shift = R
+        acov += acov_curr / n_chains
+
+        for ii, (windows, intervals) in enumerate(all_windows):
+            z = np.zeros((len(windows), D))
+            for jj, (start, stop, last_start) in enumerate(windows):
+                # Mean and var (ddof=0) of window from the running sums.
+                # Note sums are of chain - shift.
+                stats = []
+                for a, b in ((start, stop), (last_start, all_n[ii])):
+                    (n_a, s1_a, s2_a), (n_b, s1_b, s2_b) = sums[a], sums[b]
+                    n_win = float(n_b - n_a)
+                    m_win = (s1_b - s1_a) / n_win if n_win > 0 else np.nan
+                    v_win = (s2_b - s2_a) / n_win - m_win ** 2 \
+                        if n_win > 0 else np.nan
+                    stats.append((m_win, np.maximum(0.0, v_win)))
+                (m1, v1), (m2, v2) = stats
+                z[jj, :] = (m1 - m2) / np.sqrt(v1 + v2)
+            z_geweke[c_num, ii, :] = np.mean(z, axis=0) * np.sqrt(intervals)
+
+    diags = {}
+    diags['Geweke'] = np.mean(z_geweke, axis=0) * np.sqrt(n_chains)
+    diags['Gelman_Rubin'] = np.zeros((n_grid, D))
+    diags[ESS] = np.zeros((n_grid, D))
+    for ii, n in enumerate(all_n):
+        Vhat, W = between_within_var_from_moments(mu[:, ii, :], var[:, ii, :],
+                                                  n)
+        diags['Gelman_Rubin'][ii, :] = \
+            np.sqrt(Vhat / W) if n_chains >= 2 else np.nan
+
+        n_lags = min(max_lag, n)
+        rho = 1.0 - (W[None, :] - acov[ii, :n_lags, :]) / Vhat[None, :]
+        rho[:1, :] = 1.0
+        diags[ESS][ii, :] = np.nan if n < 2 else \
+            geyer_ess(rho, n_chains, n, truncated=(n_lags < n))
+    assert(set(diags.keys()) == set(STD_DIAGNOSTICS.keys()))
+    return diags
+
+
+def sync_diagnostics(all_chains, block_size=10 ** 4):
+    '''Get STD_DIAGNOSTICS for a list of equal length (possibly
+    memory-mapped) chains without stacking them into one array. Geweke and
+    R-hat come from the one pass of prefix_diagnostics(), ESS uses all lags
+    like effective_n() does.'''
+    N = all_chains[0].shape[0]
+    diags = prefix_diagnostics(all_chains, np.array([N]), max_lag=2,
+                               block_size=block_size)
+    diags = {k: v[0, :] for k, v in diags.iteritems()}
+    diags[ESS] = effective_n(all_chains)
+    return diags
+
 ESS = 'ESS'
 STD_DIAGNOSTICS = {'Geweke': geweke, 'Gelman_Rubin': gelman_rubin,
                    ESS: effective_n}
@@ -1,7 +1,14 @@
+from contextlib import contextmanager
 import os
 import numpy as np
+import xarray as xr
 
 TEMP_STR_LEN = 6
+NPY_MAGIC = '\x93NUMPY'
+NC_ENGINE = 'netcdf4'  # Need netCDF4 (HDF5) for groups and compression
+PERF_GROUP = 'perf'
+SYNC_GROUP = 'sync'
+TMP_EXT = '.tmp'
 
 # TODO some of this should go to general util
 
@@ -18,12 +25,56 @@ def abspath2(fname):
     return os.path.abspath(os.path.expanduser(fname))
 
 
-def load_np(input_path, fname, ext):
+def makedirs_safe(dir_):
+    '''Make dir_ if doesn't already exist, also ok if another job makes it
+    at the same time.'''
+    try:
+        os.makedirs(dir_)
+    except OSError:
+        if not os.path.isdir(dir_):
+            raise
+
+
+@contextmanager
+def atomic_write(fname, tmp_fname=None, mode='wb'):
+    '''Open file to write fname through. It is written to tmp_fname (fname
+    + TMP_EXT by default) then renamed, so a killed job or a concurrent
+    reader never sees a partial file. rename is atomic on POSIX.'''
+    tmp_fname = fname + TMP_EXT if tmp_fname is None else tmp_fname
+    try:
+        with open(tmp_fname, mode) as f:
+            yield f
+    except:  # Also catch KeyboardInterrupt so no temp file left behind
+        if os.path.isfile(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    os.rename(tmp_fname, fname)
+
+
+def file_stamp(fname):
+    '''Size and mtime of file, if either changes anything derived is stale.'''
+    st = os.stat(fname)
+    stamp = (st.st_size, st.st_mtime)
+    return stamp
+
+
+def is_npy(fname):
+    with open(fname, 'rb') as f:
+        magic = f.read(len(NPY_MAGIC))
+    return magic == NPY_MAGIC
+
+
+def load_np(input_path, fname, ext, mmap_mode=None):
+    '''Load chain from csv or npy file, detected from contents of file.
+    mmap_mode is passed to np.load() and so only applies to npy files.'''
     fname = os.path.join(input_path, fname + ext)
     print 'loading %s' % fname
     assert(os.path.isabs(fname))
-    X = np.genfromtxt(fname, dtype=float, delimiter=',', skip_header=0,
-                      loose=False, invalid_raise=True)
+    if is_npy(fname):
+        X = np.load(fname, mmap_mode=mmap_mode, allow_pickle=False)
+    else:
+        X = np.genfromtxt(fname, dtype=float, delimiter=',', skip_header=0,
+                          loose=False, invalid_raise=True)
     return X
 
 
@@ -35,7 +86,46 @@ def save_pd(df, output_path, tbl_name, ext, index=True):
     return fname
 
 
+def compressed_encoding(ds, chunks, complevel=4):
+    '''Chunk and compress the numeric vars of ds, chunks gives chunk size for
+    each dim and default is the whole dim.'''
+    encoding = {}
+    for name, var in ds.data_vars.iteritems():
+        if var.dtype.kind not in 'fi':  # Leave strings alone
+            continue
+        sizes = tuple(max(1, min(chunks.get(dd, ds.dims[dd]), ds.dims[dd]))
+                      for dd in var.dims)
+        encoding[name] = {'zlib': True, 'complevel': complevel,
+                          'shuffle': True, 'chunksizes': sizes}
+    return encoding
+
+
+def save_nc(ds_dict, output_path, tbl_name, ext, chunks={}):
+    '''Save dict of group name -> dataset to one netCDF4 (HDF5) file, with
+    each group chunked and compressed.'''
+    fname = os.path.join(output_path, tbl_name + ext)
+    print 'saving %s' % fname
+    assert(os.path.isabs(fname))
+    mode = 'w'
+    for group in sorted(ds_dict.keys()):
+        ds = ds_dict[group]
+        ds.to_netcdf(fname, mode=mode, group=group, engine=NC_ENGINE,
+                     encoding=compressed_encoding(ds, chunks))
+        mode = 'a'  # Other groups go in same file
+    return fname
+
+
+def open_nc(fname, group):
+    '''Lazy, data is only read from disk when accessed.'''
+    print 'opening %s' % fname
+    ds = xr.open_dataset(fname, group=group, engine=NC_ENGINE)
+    return ds
+
+
 def find_traces(input_path, exact_name, ext, sep='_', sub_sep='-'):
+    '''ext can also be a tuple of allowed extensions for the chain files.'''
+    exts = (ext,) if isinstance(ext, basestring) else tuple(ext)
+
     # Sort not needed here, but general good practice with os.listdir()
     files = sorted(os.listdir(input_path))
     # Could assert unique here if we wanted to be sure
@@ -44,10 +134,12 @@ def find_traces(input_path, exact_name, ext, sep='_', sub_sep='-'):
     samplers_to_use = set()  # Can exluce exact from list of samplers
     file_lookup = {}
     for fname in files:
-        if not fname.endswith(ext):
+        curr_ext = [ee for ee in exts if fname.endswith(ee)]
+        if len(curr_ext) == 0:
             continue  # skip .meta files
         curr_example, curr_sampler = \
-            parse_sampler_name(fname, ext=ext, sep=sep, sub_sep=sub_sep)
+            parse_sampler_name(fname, ext=curr_ext[0], sep=sep,
+                               sub_sep=sub_sep)
 
         # Note: may contain examples and samplers not in the to_use lists
         S = file_lookup.setdefault((curr_example, curr_sampler), set())
@@ -2,17 +2,22 @@
 import ConfigParser
 import os
 import sys
+from multiprocessing import Pool, cpu_count
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 import xarray as xr
-from diagnostics import STD_DIAGNOSTICS
+from diagnostics import STD_DIAGNOSTICS, prefix_diagnostics, sync_diagnostics
 import fileio as io
 from metrics import MOMENT_METRICS, OTHER_METRICS
 from metrics import eval_inc, eval_total, eval_pooled
+from ref_cache import get_exact_ref, standardize_exact
+from cell_store import cell_key, load_cell, save_cell
 
 SAMPLE_INDEX_COL = 'sample'
 SKIPNA = True
+# Chunk the perf cube so each chunk is all of time and examples for one
+# sampler and metric. Chunk size for any dim not here is the whole dim.
+NC_CHUNKS = {'sampler': 1, 'metric': 1, 'row': 2 ** 16}
 
 
 def resample(X, N):
@@ -34,19 +39,44 @@ def init_data_array(coords, value=np.nan):
     return X
 
 
-def xr_unstack(da, index):
-    dims_list = list(da.coords.dims)
-    dims_list.remove(index)
-
-    df = da.to_dataframe('foo').unstack(level=index)
-    df.columns = df.columns.droplevel(level=0)
-    df = df.T
-    assert(df.index.name == index)
-    assert(df.columns.names == dims_list)
+def cube_to_df(da):
+    '''Export data array to data frame with the first dim as index and the
+    rest as column multi-index. Unlike to_dataframe().unstack() this is only a
+    reshape of the dense array.'''
+    index, col_dims = da.dims[0], list(da.dims[1:])
+    cols = pd.MultiIndex.from_product([da.coords[dd].values
+                                       for dd in col_dims], names=col_dims)
+    df = pd.DataFrame(da.values.reshape((da.shape[0], -1)),
+                      index=pd.Index(da.coords[index].values, name=index),
+                      columns=cols)
     return df
 
 
-def combine_chains(chains):
+class StandardizedChain(object):
+    '''Read only view of a (possibly memory-mapped) chain that standardizes
+    rows on access, so only the block being sliced gets a scaled copy in
+    memory. Supports the row slicing used on chains in the metrics.'''
+
+    def __init__(self, X, center, scale):
+        assert(np.ndim(X) == 2)
+        D = X.shape[1]
+        assert(center.shape == (D,) and scale.shape == (D,))
+        self.X, self.center, self.scale = X, center, scale
+        self.shape = X.shape
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        block = (self.X[rows, cols] - self.center[cols]) / self.scale[cols]
+        return block
+
+
+def chain_tails(chains):
+    '''Views of the last min_n rows of each chain, where min_n is the
+    shortest chain length, without copying any of them.'''
     assert(len(chains) >= 1)
     D = chains[0].shape[1]
     assert(all(np.ndim(x) == 2 and x.shape[1] == D for x in chains))
@@ -54,9 +84,15 @@ def combine_chains(chains):
     assert(min_n > 0)
 
     # Take end since these are the best samples, could also thin to size
-    combo = np.stack([x[-min_n:, :] for x in chains], axis=0)
-    assert(combo.shape == (len(chains), min_n, D))
-    return combo
+    tails = []
+    for x in chains:
+        start = x.shape[0] - min_n
+        if isinstance(x, StandardizedChain):
+            tails.append(StandardizedChain(x.X[start:], x.center, x.scale))
+        else:
+            tails.append(x[start:])
+        assert(tails[-1].shape == (min_n, D))
+    return tails
 
 
 def load_config(config_file):
@@ -72,9 +108,20 @@ def load_config(config_file):
     D['n_chains'] = config.getint('phase3', 'n_chains')
 
     D['csv_ext'] = config.get('common', 'csv_ext')
+    D['npy_ext'] = config.get('common', 'npy_ext')
+    D['nc_ext'] = config.get('common', 'nc_ext')
     D['meta_ext'] = config.get('common', 'meta_ext')
+    D['ref_ext'] = config.get('phase4', 'ref_ext')
+    store_path = config.get('phase4', 'cell_store_path')
+    D['cell_store_path'] = None if store_path == '' else \
+        io.abspath2(store_path)
     D['exact_name'] = config.get('common', 'exact_name')
 
+    # Leave blank to use all cores
+    njobs = config.get('phase4', 'njobs')
+    D['njobs'] = cpu_count() if njobs == '' else int(njobs)
+    assert(D['njobs'] >= 1)
+
     return D
 
 
@@ -91,116 +138,172 @@ def load_meta(input_path, fname, meta_ext, n_grid):
     return sample_idx
 
 
+def eval_cell(exact_ref, center, scale, file_list, metrics, config,
+              exact_chain=None):
+    '''Compute performance numbers for the chains in file_list of one
+    sampler x example cell. Returns dict of metric -> n_grid array of perf
+    over time and sync perf data frame. If exact_chain is given, the chains
+    are bootstrap resampled from it instead of loaded.'''
+    n_grid = config['n_grid']
+    metrics_sync = STD_DIAGNOSTICS.keys() + metrics
+    D = center.shape[0]
+
+    perf = {}
+
+    # Iterate over chains into one big list data struct
+    all_chains = []
+    all_meta = np.zeros((n_grid, len(file_list)), dtype=int)
+    for ii, fname in enumerate(file_list):
+        all_meta[:, ii] = load_meta(config['input_path'], fname,
+                                    config['meta_ext'], n_grid)
+        if exact_chain is not None:
+            curr_chain = resample(exact_chain, all_meta[-1, ii])
+        else:  # Load actual data, but leave it on disk for now
+            curr_chain = io.load_np(config['input_path'], fname, '',
+                                    mmap_mode='r')
+            curr_chain = StandardizedChain(curr_chain, center, scale)
+        assert(curr_chain.shape[1] == D)
+        all_chains.append(curr_chain)
+
+    # Do analyses that can be done with unequal length chains
+    print 'async analysis'
+    err = eval_inc(exact_ref, all_chains, metrics, all_meta)
+    for metric in metrics:
+        assert(err[metric].shape == (n_grid,))
+        perf[metric] = err[metric]
+    perf['N'] = hmean(all_meta, axis=1)
+
+    print 'diagnostics over time'
+    # Use equal length prefixes of chains at each point in time
+    n_sync = np.min(all_meta, axis=1)
+    diags = prefix_diagnostics(all_chains, n_sync)
+    for diag_name, score in diags.iteritems():
+        assert(score.shape == (n_grid, D))
+        perf[diag_name] = np.mean(score, axis=1)
+
+    print 'sync analysis'
+    # Do analyses that can only be done @ end with equal len chains
+    all_chains = chain_tails(all_chains)  # Views, nothing is copied
+    df = pd.DataFrame(index=xrange(D), columns=metrics_sync)
+    df.index.name = 'dim'
+    err = eval_total(exact_ref, all_chains, metrics)
+    err_pooled = eval_pooled(exact_ref, all_chains, metrics)
+    for metric in metrics:
+        assert(err[metric].shape == (D,))
+        df[metric] = err[metric]
+        assert(err_pooled[metric].shape == (D,))
+        df[metric + '_pooled'] = err_pooled[metric]
+    for diag_name, score in sync_diagnostics(all_chains).iteritems():
+        assert(score.shape == (D,))
+        df[diag_name] = score
+    df['D'] = D
+    df['N'] = all_chains[0].shape[0]
+    df['n_chains'] = len(all_chains)
+    return perf, df
+
+
+def eval_example(example, samplers, metrics, file_lookup, config,
+                 bootstrap_test=False):
+    '''Compute all the performance numbers for one example. Examples are
+    independent so this can be run in parallel. Returns dict of
+    (sampler, example, metric) -> n_grid array of perf over time and dict of
+    (sampler, example) -> sync perf data frame.'''
+    n_chains, n_grid = config['n_chains'], config['n_grid']
+
+    perf = {}
+    sync_perf = {}
+
+    fname_exact = file_lookup[(example, config['exact_name'])]
+    if len(fname_exact) != 1:
+        print 'warning expected 1 exact file, found %d' % len(fname_exact)
+    fname_exact = sorted(fname_exact)[0]
+    # Results are random in bootstrap test so do not use store
+    store_path = None if bootstrap_test else config['cell_store_path']
+
+    exact_ref = None  # Load lazily in case all cells are in store
+    for sampler in samplers:
+        # Go in sorted order to keep it reproducible
+        file_list = sorted(file_lookup.get((example, sampler), []))
+        print 'found %d / %d chains for %s x %s' % \
+            (len(file_list), n_chains, example, sampler)
+        if len(file_list) == 0:  # Nothing to do
+            continue
+
+        key = cell_key(config['input_path'], fname_exact, file_list,
+                       config['meta_ext'], metrics, n_grid)
+        cell = None
+        if store_path is not None:
+            cell = load_cell(store_path, sampler, example, key)
+        if cell is None:
+            if exact_ref is None:
+                # Only touches the exact chain if the cached stats are stale
+                exact_ref, center, scale = \
+                    get_exact_ref(config['input_path'], fname_exact,
+                                  config['ref_ext'], metrics)
+                exact_chain = None
+                if bootstrap_test:  # Need exact chain to resample from
+                    exact_chain = io.load_np(config['input_path'],
+                                             fname_exact, ext='')
+                    exact_chain, _, _ = standardize_exact(exact_chain)
+            cell = eval_cell(exact_ref, center, scale, file_list, metrics,
+                             config, exact_chain)
+            if store_path is not None:
+                save_cell(store_path, sampler, example, key, cell)
+
+        perf_cell, sync_perf[(sampler, example)] = cell
+        for metric, err in perf_cell.iteritems():
+            perf[(sampler, example, metric)] = err
+    return perf, sync_perf
+
+
+def eval_example_star(args):
+    '''Since Pool.imap() only passes one arg.'''
+    return eval_example(*args)
+
+
 def build_metrics_array(samplers, examples, metrics, file_lookup, config,
-                        bootstrap_test=False):
+                        bootstrap_test=False, njobs=1):
     '''Aggregate all the performance numbers into huge array'''
     n_chains, n_grid = config['n_chains'], config['n_grid']
     print 'expect %d chains per case' % n_chains
 
-    # Will want to settle on all xr or all pd once we know what is easier.
+    # Assume later that these keys are distinct
+    assert(set(metrics).isdisjoint(STD_DIAGNOSTICS.keys()))
+    # Diagnostics over time are averaged over dims to fit in the perf cube
+    metrics_inc = metrics + sorted(STD_DIAGNOSTICS.keys())
+
+    # One dense array for everything, N is stored as an extra metric
     coords = [('time', xrange(n_grid)), ('sampler', samplers),
-              ('example', examples), ('metric', metrics)]
+              ('example', examples), ('metric', metrics_inc + ['N'])]
     perf = init_data_array(coords)
-    # Skip metric for n_count
-    n_count = init_data_array(coords[:-1])
 
-    cols = pd.MultiIndex.from_product([samplers, examples, metrics + ['N']],
-                                      names=['sampler', 'example', 'metric'])
-    perf_df = pd.DataFrame(index=xrange(n_grid), columns=cols, dtype=float)
-    perf_df.index.name = 'time'
+    # Each example is independent given its exact chain
+    jobs = [(example, samplers, metrics, file_lookup, config, bootstrap_test)
+            for example in examples]
+    if njobs == 1:
+        results = map(eval_example_star, jobs)
+    else:
+        pool = Pool(njobs)
+        results = pool.imap(eval_example_star, jobs, chunksize=1)
 
-    # Assume later that these keys are distinct
-    assert(set(metrics).isdisjoint(STD_DIAGNOSTICS.keys()))
-    metrics_sync = STD_DIAGNOSTICS.keys() + metrics
+    # Merge results as they come in, imap keeps them in order of examples
     sync_perf = {}
-    for example in examples:
-        fname_exact = file_lookup[(example, config['exact_name'])]
-        if len(fname_exact) != 1:
-            print 'warning expected 1 exact file, found %d' % len(fname_exact)
-        fname = fname_exact.pop()
-
-        exact_chain = io.load_np(config['input_path'], fname, ext='')
-        print exact_chain.shape
-        D = exact_chain.shape[1]
-        # TODO add warning if need to remove any
-        keep = np.all(np.isfinite(exact_chain), axis=1)
-        exact_chain = exact_chain[keep, :]
-        print exact_chain.shape
-
-        # In ESS calculations we assume that var=1, so we need standard scaler
-        # and not robust, but maybe we could add warning if the two diverge.
-        scaler = StandardScaler()
-        exact_chain = scaler.fit_transform(exact_chain)
-        for sampler in samplers:
-            # Go in sorted order to keep it reproducible
-            file_list = sorted(file_lookup.get((example, sampler), []))
-            print 'found %d / %d chains for %s x %s' % \
-                (len(file_list), n_chains, example, sampler)
-            if len(file_list) == 0:  # Nothing to do
-                continue
-
-            # Iterate over chains into one big list data struct
-            all_chains = []
-            all_meta = np.zeros((n_grid, len(file_list)), dtype=int)
-            for ii, fname in enumerate(file_list):
-                all_meta[:, ii] = load_meta(config['input_path'], fname,
-                                            config['meta_ext'], n_grid)
-                if bootstrap_test:
-                    curr_chain = resample(exact_chain, all_meta[-1, ii])
-                else:  # Load actual data
-                    curr_chain = io.load_np(config['input_path'], fname, '')
-                    curr_chain = scaler.transform(curr_chain)
-                assert(curr_chain.shape[1] == D)
-                all_chains.append(curr_chain)
-
-            # Do analyses that can be done with unequal length chains
-            print 'async analysis'
-            for metric in metrics:
-                err = eval_inc(exact_chain, all_chains, metric, all_meta)
-                assert(err.shape == (n_grid,))
-                perf.loc[:, sampler, example, metric] = err
-                perf_df[(sampler, example, metric)] = err
-            n_count.loc[:, sampler, example] = hmean(all_meta, axis=1)
-            perf_df[(sampler, example, 'N')] = hmean(all_meta, axis=1)
-
-            print 'sync analysis'
-            # Do analyses that can only be done @ end with equal len chains
-            all_chains = combine_chains(all_chains)  # Now np array
-            df = pd.DataFrame(index=xrange(D), columns=metrics_sync)
-            df.index.name = 'dim'
-            for metric in metrics:
-                err = eval_total(exact_chain, all_chains, metric)
-                assert(err.shape == (D,))
-                df[metric] = err
-                err = eval_pooled(exact_chain, all_chains, metric)
-                assert(err.shape == (D,))
-                df[metric + '_pooled'] = err
-            for diag_name, diag_f in STD_DIAGNOSTICS.iteritems():
-                score = diag_f(all_chains)
-                assert(score.shape == (D,))
-                df[diag_name] = score
-            df['D'] = D
-            df['N'] = all_chains.shape[1]
-            df['n_chains'] = all_chains.shape[0]
-            sync_perf[(sampler, example)] = df
+    for perf_curr, sync_perf_curr in results:
+        for (sampler, example, metric), err in perf_curr.iteritems():
+            perf.loc[:, sampler, example, metric] = err
+        sync_perf.update(sync_perf_curr)
+    if njobs != 1:
+        pool.close()
+        pool.join()
+
     sync_perf = pd.concat(sync_perf, axis=0)
     assert(sync_perf.index.names == [None, None, 'dim'])
     sync_perf.index.names = ['sampler', 'example', 'dim']
     sync_perf.reset_index(drop=False, inplace=True)
 
-    # Compare aggregation with pandas vs xarray
-    perf_df2 = xr_unstack(perf, 'time')
-    for metric in metrics:
-        chk1 = perf_df.xs(metric, axis=1, level='metric')
-        chk2 = perf_df2.xs(metric, axis=1, level='metric')
-        assert(chk1.equals(chk2))
-    chk1 = xr_unstack(n_count, 'time')
-    chk2 = perf_df.xs('N', axis=1, level='metric')
-    assert(chk1.equals(chk2))
-
     # We could add an extra example which is average of all examples, or can
     # do in next phase.
-    return perf_df, sync_perf
+    return perf, sync_perf
 
 
 def main():
@@ -210,8 +313,9 @@ def main():
     config = load_config(config_file)
     ext = config['csv_ext']
 
+    chain_exts = (config['csv_ext'], config['npy_ext'])
     samplers, examples, file_lookup = \
-        io.find_traces(config['input_path'], config['exact_name'], ext)
+        io.find_traces(config['input_path'], config['exact_name'], chain_exts)
     print 'found %d samplers and %d examples' % (len(samplers), len(examples))
     print '%d files in lookup table' % \
         sum(len(file_lookup[k]) for k in file_lookup)
@@ -223,16 +327,24 @@ def main():
     print examples
 
     metrics = MOMENT_METRICS.keys() + OTHER_METRICS.keys()
-    R = build_metrics_array(samplers, examples, metrics, file_lookup, config)
-    perf_df, sync_perf = R
+    R = build_metrics_array(samplers, examples, metrics, file_lookup, config,
+                            njobs=config['njobs'])
+    perf, sync_perf = R
 
     # Save TS, make sure it has enough info to compute ess and eff
-    io.save_pd(perf_df, config['output_path'], 'perf', ext)
+    io.save_pd(cube_to_df(perf), config['output_path'], 'perf', ext)
 
     # Save diagnostics, make sure it has enough info to compute ess and eff
     io.save_pd(sync_perf, config['output_path'], 'perf_sync', ext, index=False)
 
-    # Could also include option to dump everything in netCDF if we want
+    # Same in binary so later phases can read parts without parsing csv. The
+    # sync table is kept flat since the examples have different dims.
+    sync_perf.index.name = 'row'
+    ds_dict = {io.PERF_GROUP: perf.to_dataset(name='perf'),
+               io.SYNC_GROUP: xr.Dataset.from_dataframe(sync_perf)}
+    io.save_nc(ds_dict, config['output_path'], 'perf', config['nc_ext'],
+               chunks=NC_CHUNKS)
+
     print 'done'
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import scipy.stats as ss
 #from diagnostics import MIN_ESS
 
 MIN_ESS_PER_CHAIN = 1.0  # TODO limit dupes
+BLOCK_SIZE = 10 ** 4  # Max rows of a chain to pull into memory at once
 
 
 def stack_first(X):
@@ -22,6 +23,37 @@ def interleave(X):
     return Y
 
 
+class PooledChain(object):
+    '''Read only view of chains put end to end, same rows as stack_first()
+    on them, that only pulls the rows being sliced into memory. Supports the
+    row slicing used on chains in the metrics.'''
+
+    def __init__(self, all_chains):
+        assert(len(all_chains) >= 1)
+        D = all_chains[0].shape[1]
+        assert(all(np.ndim(x) == 2 and x.shape[1] == D for x in all_chains))
+        self.all_chains = all_chains
+        self.ends = np.cumsum([x.shape[0] for x in all_chains])
+        self.shape = (self.ends[-1], D)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        start, stop, step = rows.indices(self.shape[0])
+        assert(step == 1)
+        blocks = [np.zeros((0, self.shape[1]))]
+        for chain, end in zip(self.all_chains, self.ends):
+            begin = end - chain.shape[0]
+            if begin < stop and start < end:
+                blocks.append(chain[max(start, begin) - begin:
+                                    min(stop, end) - begin, :])
+        block = np.concatenate(blocks, axis=0)[:, cols]
+        return block
+
+
 def mean(chain):
     assert(np.ndim(chain) == 2)
     return np.mean(chain, axis=0)
@@ -33,6 +65,104 @@ def var(chain):
     return np.var(chain, axis=0, ddof=1)
 
 
+def prefix_moments(chain, all_n, block_size=BLOCK_SIZE):
+    '''Get mean and unbiased var of chain[:n, :] for every n in all_n in one
+    pass over chain. Block stats are merged in with the pairwise update of
+    Chan et al. which is more stable than using sum of squares. Like the
+    batch versions, mean is nan for n < 1 and var is nan for n < 2.'''
+    assert(np.ndim(chain) == 2)
+    D = chain.shape[1]
+    assert(np.ndim(all_n) == 1)
+    assert(np.all(np.diff(all_n) >= 0))
+
+    mu_all = np.zeros((len(all_n), D))
+    var_all = np.zeros((len(all_n), D))
+
+    count, mu, M2 = 0, np.zeros(D), np.zeros(D)
+    for ii, n_samples in enumerate(all_n):
+        # Consume chain up to n_samples, in blocks to bound memory
+        while count < min(n_samples, chain.shape[0]):
+            stop = min(n_samples, count + block_size)
+            block = chain[count:stop, :]
+            n_block = block.shape[0]
+            mu_block = np.mean(block, axis=0)
+            M2_block = np.sum((block - mu_block[None, :]) ** 2, axis=0)
+
+            n_new = count + n_block
+            delta = mu_block - mu
+            mu = mu + delta * (n_block / float(n_new))
+            M2 = M2 + M2_block + delta ** 2 * (count * n_block / float(n_new))
+            count = n_new
+        mu_all[ii, :] = mu if count >= 1 else np.nan
+        var_all[ii, :] = M2 / (count - 1) if count >= 2 else np.nan
+    return mu_all, var_all
+
+
+def sort_marginals(exact):
+    '''Reference needed by prefix_ks(), so exact only gets sorted once.'''
+    assert(np.ndim(exact) == 2)
+    M, D = exact.shape
+
+    exact_sorted = np.sort(exact, axis=0)
+    # Exact cdf at each of the sorted points, right-continuous like ks_2samp
+    cdf = np.zeros((M, D))
+    for ii in xrange(D):
+        cdf[:, ii] = np.searchsorted(exact_sorted[:, ii], exact_sorted[:, ii],
+                                     side='right')
+    cdf = cdf / M
+    # Mark the last point in each group of tied values
+    last = np.ones((M, D), dtype=bool)
+    last[:-1, :] = exact_sorted[1:, :] != exact_sorted[:-1, :]
+    return exact_sorted, cdf, last
+
+
+def prefix_ks(exact_ref, chain, all_n, block_size=BLOCK_SIZE):
+    '''Get KS stat (same as ks_2samp) between exact and chain[:n, :] for every
+    n in all_n, in one pass over chain. exact_ref comes from sort_marginals().
+
+    The chain is only tracked through histograms over ranks in the sorted
+    exact sample: the number of chain points <= and < each exact point. The
+    KS stat is the max deviation at the ends of the intervals between exact
+    points, which a cumsum over the histograms gives us.'''
+    exact_sorted, cdf, last = exact_ref
+    M, D = exact_sorted.shape
+    assert(np.ndim(chain) == 2 and chain.shape[1] == D)
+    assert(np.ndim(all_n) == 1)
+    assert(np.all(np.diff(all_n) >= 0))
+
+    hist_le = np.zeros((M + 1, D), dtype=int)  # x <= exact_sorted[j] for >= j
+    hist_lt = np.zeros((M + 1, D), dtype=int)  # x < exact_sorted[j] for >= j
+
+    ks_all = np.zeros((len(all_n), D))
+    count, ks_stat = 0, np.nan + np.zeros(D)
+    for ii, n_samples in enumerate(all_n):
+        prev_count = count
+        while count < min(n_samples, chain.shape[0]):
+            stop = min(n_samples, count + block_size)
+            block = chain[count:stop, :]
+            for jj in xrange(D):
+                rank = np.searchsorted(exact_sorted[:, jj], block[:, jj],
+                                       side='left')
+                hist_le[:, jj] += np.bincount(rank, minlength=M + 1)
+                rank = np.searchsorted(exact_sorted[:, jj], block[:, jj],
+                                       side='right')
+                hist_lt[:, jj] += np.bincount(rank, minlength=M + 1)
+            count += block.shape[0]
+
+        if count > prev_count:  # Otherwise same as last grid point
+            cdf_le = np.cumsum(hist_le, axis=0)[:M, :] / float(count)
+            cdf_lt = np.cumsum(hist_lt, axis=0) / float(count)
+            # Chain points below all exact points, where exact cdf is 0
+            dev_left = cdf_lt[0, :]
+            # At each exact point
+            dev_at = np.max(np.abs(cdf - cdf_le), axis=0)
+            # Just before the next exact point, skip empty intervals at ties
+            dev_before = np.max(last * np.abs(cdf - cdf_lt[1:, :]), axis=0)
+            ks_stat = np.maximum(dev_left, np.maximum(dev_at, dev_before))
+        ks_all[ii, :] = ks_stat
+    return ks_all
+
+
 def ks(exact, chain):
     assert(np.ndim(exact) == 2)
     D = exact.shape[1]
@@ -44,7 +174,17 @@ def ks(exact, chain):
 
 
 MOMENT_METRICS = {'mean': mean, 'var': var}
+# Versions of moment metrics for all prefixes of chain in one go, as index
+# into the output of prefix_moments() so it is only run once for all of them.
+MOMENT_METRICS_INC = {'mean': 0, 'var': 1}
+assert(set(MOMENT_METRICS.keys()) == set(MOMENT_METRICS_INC.keys()))
 OTHER_METRICS = {'ks': ks}
+# Versions of other metrics for all prefixes of chain in one go, these need a
+# reference built from the exact chain first.
+OTHER_METRICS_REF = {'ks': sort_marginals}
+OTHER_METRICS_INC = {'ks': prefix_ks}
+assert(set(OTHER_METRICS.keys()) == set(OTHER_METRICS_INC.keys()))
+assert(set(OTHER_METRICS.keys()) == set(OTHER_METRICS_REF.keys()))
 
 # Defined as expected loss for N(0,1) * n_samples
 METRICS_REF = {'mean': 1.0, 'var': 2.0, 'ks': 0.822}
@@ -55,93 +195,102 @@ def rectified_sq_error(exact, approx, clip):
     return err
 
 
-def eval_inc(exact_chain, all_chains, metric, all_idx):
+def build_exact_ref(exact_chain, metrics):
+    '''Get dict of metric -> tuple of reference stats of the exact chain used
+    by eval_inc(), eval_total(), and eval_pooled(). These only depend on the
+    exact chain so they can be computed once per example and cached.'''
+    exact_ref = {}
+    for metric in metrics:
+        if metric in MOMENT_METRICS:
+            exact_ref[metric] = (MOMENT_METRICS[metric](exact_chain),)
+        else:
+            assert(metric in OTHER_METRICS)
+            exact_ref[metric] = OTHER_METRICS_REF[metric](exact_chain)
+    return exact_ref
+
+
+def prefix_estimates(exact_ref, chain, metrics, all_n):
+    '''Get dict of metric -> (exact, approx) for each of metrics, where
+    approx is the estimate on chain[:n, :] for every n in all_n. The moment
+    metrics share one pass over chain, the other metrics get a pass each.'''
+    estimates = {}
+    if any(metric in MOMENT_METRICS for metric in metrics):
+        moments = prefix_moments(chain, all_n)
+    for metric in metrics:
+        if metric in MOMENT_METRICS:
+            exact, = exact_ref[metric]
+            approx = moments[MOMENT_METRICS_INC[metric]]
+        else:
+            assert(metric in OTHER_METRICS)
+            exact = 0.0
+            approx = OTHER_METRICS_INC[metric](exact_ref[metric], chain, all_n)
+        assert(approx.shape == (len(all_n), chain.shape[1]))
+        estimates[metric] = (exact, approx)
+    return estimates
+
+
+def eval_inc(exact_ref, all_chains, metrics, all_idx):
+    '''Get dict of metric -> n_grid array of error ave over chains, for the
+    first all_idx[:, c_num] samples of each chain.'''
     n_grid, n_chains = all_idx.shape
     assert(n_chains >= 1)
     assert(len(all_chains) == n_chains)
     D = all_chains[0].shape[1]
 
-    if metric in MOMENT_METRICS:
-        estimator = MOMENT_METRICS[metric]
-        exact = estimator(exact_chain)
-        moment_metric = True
-    else:
-        assert(metric in OTHER_METRICS)
-        estimator = OTHER_METRICS[metric]
-        moment_metric = False
-
-    clip = METRICS_REF[metric] / MIN_ESS_PER_CHAIN
-
-    err = np.zeros((n_grid, n_chains))
+    err = {metric: np.zeros((n_grid, n_chains)) for metric in metrics}
     for c_num, chain in enumerate(all_chains):
         assert(chain.ndim == 2 and chain.shape[1] == D)
-        # Just do it naively right now instead of online & incremental
-        for ii, n_samples in enumerate(all_idx[:, c_num]):
-            if moment_metric:
-                approx = estimator(chain[:n_samples, :])
-                err[ii, c_num] = np.mean(rectified_sq_error(exact, approx, clip))
-            else:
-                approx = estimator(exact_chain, chain[:n_samples, :])
-                err[ii, c_num] = np.mean(rectified_sq_error(0.0, approx, clip))
-    err = np.mean(err, axis=1)  # ave over chains
-    assert(err.shape == (n_grid,))
+        # All grid points in one pass over chain
+        estimates = prefix_estimates(exact_ref, chain, metrics,
+                                     all_idx[:, c_num])
+        for metric, (exact, approx) in estimates.iteritems():
+            clip = METRICS_REF[metric] / MIN_ESS_PER_CHAIN
+            err[metric][:, c_num] = \
+                np.mean(rectified_sq_error(exact, approx, clip), axis=1)
+    # ave over chains
+    err = {metric: np.mean(err[metric], axis=1) for metric in metrics}
     return err
 
 
-def eval_total(exact_chain, all_chains, metric):
-    n_chains = len(all_chains)
-    assert(n_chains >= 1)
-    D = exact_chain.shape[1]
-    assert(exact_chain.ndim == 2)
+def eval_full(exact_ref, chain, metrics):
+    '''Get dict of metric -> (exact, approx) for all of chain using
+    exact_ref. This is the last point of the prefix version, so chain only
+    gets read in blocks.'''
+    estimates = prefix_estimates(exact_ref, chain, metrics,
+                                 np.array([chain.shape[0]]))
+    estimates = {metric: (exact, approx[0, :])
+                 for metric, (exact, approx) in estimates.iteritems()}
+    return estimates
 
-    if metric in MOMENT_METRICS:
-        estimator = MOMENT_METRICS[metric]
-        exact = estimator(exact_chain)
-        moment_metric = True
-    else:
-        assert(metric in OTHER_METRICS)
-        estimator = OTHER_METRICS[metric]
-        moment_metric = False
 
-    clip = METRICS_REF[metric] / MIN_ESS_PER_CHAIN
+def eval_total(exact_ref, all_chains, metrics):
+    '''Get dict of metric -> D array of error on each chain, ave over
+    chains.'''
+    n_chains = len(all_chains)
+    assert(n_chains >= 1)
+    D = all_chains[0].shape[1]
 
-    err = np.zeros((D, n_chains))
+    err = {metric: np.zeros((D, n_chains)) for metric in metrics}
     for c_num, chain in enumerate(all_chains):
         assert(chain.ndim == 2 and chain.shape[1] == D)
-        if moment_metric:
-            approx = estimator(chain)
-            err[:, c_num] = rectified_sq_error(exact, approx, clip)
-        else:
-            approx = estimator(exact_chain, chain)
-            err[:, c_num] = rectified_sq_error(0.0, approx, clip)
-    err = np.mean(err, axis=1)  # ave over chains
-    assert(err.shape == (D,))
+        estimates = eval_full(exact_ref, chain, metrics)
+        for metric, (exact, approx) in estimates.iteritems():
+            clip = METRICS_REF[metric] / MIN_ESS_PER_CHAIN
+            err[metric][:, c_num] = rectified_sq_error(exact, approx, clip)
+    # ave over chains
+    err = {metric: np.mean(err[metric], axis=1) for metric in metrics}
     return err
 
 
-def eval_pooled(exact_chain, all_chains, metric):
+def eval_pooled(exact_ref, all_chains, metrics):
+    '''Get dict of metric -> D array of error on all chains pooled.'''
     n_chains = len(all_chains)
     assert(n_chains >= 1)
-    D = exact_chain.shape[1]
-    assert(exact_chain.ndim == 2)
-
-    if metric in MOMENT_METRICS:
-        estimator = MOMENT_METRICS[metric]
-        exact = estimator(exact_chain)
-        moment_metric = True
-    else:
-        assert(metric in OTHER_METRICS)
-        estimator = OTHER_METRICS[metric]
-        moment_metric = False
-
-    clip = METRICS_REF[metric] / (MIN_ESS_PER_CHAIN * n_chains)
-
-    all_chains = stack_first(np.asarray(all_chains))
-    if moment_metric:
-        approx = estimator(all_chains)
-        err = rectified_sq_error(exact, approx, clip)
-    else:
-        approx = estimator(exact_chain, all_chains)
-        err = rectified_sq_error(0.0, approx, clip)
-    assert(err.shape == (D,))
+
+    # Same as stack_first() on the chains but without the copy
+    estimates = eval_full(exact_ref, PooledChain(all_chains), metrics)
+    err = {}
+    for metric, (exact, approx) in estimates.iteritems():
+        clip = METRICS_REF[metric] / (MIN_ESS_PER_CHAIN * n_chains)
+        err[metric] = rectified_sq_error(exact, approx, clip)
     return err
@@ -7,6 +7,7 @@ from sklearn.preprocessing import RobustScaler
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF, WhiteKernel
 from metrics import METRICS_REF
+import fileio as io
 
 import bt.benchmark_tools_regr as btr
 import bt.data_splitter as ds
@@ -299,13 +300,16 @@ def meta_analysis_tex(df):
     return perf_tex
 
 # TODO config
-fname = '../../sampler-local/cedar1_P4/perf_sync.csv'
+fname = '../../sampler-local/cedar1_P4/perf.nc'
 
 np.random.seed(56456)
 do_plots = True
 
-df = pd.read_csv(fname, header=0, index_col=None)
-df = df[df['n_chains'] > 1]  # Filter out where no way to average error
+sync_ds = io.open_nc(fname, io.SYNC_GROUP)
+# Filter out where no way to average error, only n_chains read from disk
+keep = np.flatnonzero(sync_ds['n_chains'].values > 1)
+df = sync_ds.isel(row=keep).to_dataframe()
+df.reset_index(drop=True, inplace=True)
 
 agg_df = aggregate_df(df)
 df = augment_df(df)
@@ -0,0 +1,77 @@
+# Ryan Turner (turnerry@iro.umontreal.ca)
+import os
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+import fileio as io
+from metrics import build_exact_ref
+
+# Keys for the non-metric entries in the cache file
+CENTER = 'center'
+SCALE = 'scale'
+STAMP = 'stamp'
+SEP = ':'  # Metric names must not contain this
+
+
+def standardize_exact(exact_chain):
+    '''Drop non-finite rows and standardize. In ESS calculations we assume
+    that var=1, so we need standard scaler and not robust, but maybe we could
+    add warning if the two diverge.'''
+    # TODO add warning if need to remove any
+    keep = np.all(np.isfinite(exact_chain), axis=1)
+    exact_chain = exact_chain[keep, :]
+    print exact_chain.shape
+
+    scaler = StandardScaler()
+    exact_chain = scaler.fit_transform(exact_chain)
+    return exact_chain, scaler.mean_, scaler.scale_
+
+
+def save_ref(fname, exact_ref, center, scale, stamp):
+    D = {CENTER: center, SCALE: scale, STAMP: stamp}
+    for metric, ref in exact_ref.iteritems():
+        assert(SEP not in metric)
+        for ii, x in enumerate(ref):
+            D[metric + SEP + str(ii)] = x
+    with io.atomic_write(fname) as f:
+        np.savez(f, **D)
+    print 'saved %s' % fname
+
+
+def load_ref(fname, metrics, stamp):
+    '''Returns None if cache is missing, stale, or missing any metric.'''
+    if not os.path.isfile(fname):
+        return None
+    with np.load(fname, allow_pickle=False) as D:
+        if not np.array_equal(D[STAMP], stamp):
+            print 'stale %s' % fname
+            return None
+        exact_ref = {}
+        for metric in metrics:
+            keys = sorted((k for k in D.files
+                           if k.rsplit(SEP, 1)[0] == metric),
+                          key=lambda k: int(k.rsplit(SEP, 1)[1]))
+            if len(keys) == 0:
+                return None
+            exact_ref[metric] = tuple(D[k] for k in keys)
+        center, scale = D[CENTER], D[SCALE]
+    print 'loaded %s' % fname
+    return exact_ref, center, scale
+
+
+def get_exact_ref(input_path, fname, ref_ext, metrics):
+    '''Get reference stats of the exact chain in fname for metrics, along with
+    the center and scale used to standardize it. These are cached next to the
+    exact chain so the exact chain is only loaded when it changes.'''
+    exact_file = os.path.join(input_path, fname)
+    ref_file = exact_file + ref_ext
+    stamp = np.array(io.file_stamp(exact_file), dtype=float)
+
+    R = load_ref(ref_file, metrics, stamp)
+    if R is None:
+        exact_chain = io.load_np(input_path, fname, ext='')
+        print exact_chain.shape
+        exact_chain, center, scale = standardize_exact(exact_chain)
+        exact_ref = build_exact_ref(exact_chain, metrics)
+        save_ref(ref_file, exact_ref, center, scale, stamp)
+        R = exact_ref, center, scale
+    return R
@@ -15,9 +15,11 @@ def main():
     input_exact = io.abspath2(config.get('phase3', 'output_path'))
     exact_name = config.get('common', 'exact_name')
     csv_ext = config.get('common', 'csv_ext')
+    npy_ext = config.get('common', 'npy_ext')
     sep = '_'
 
-    _, examples, file_lookup = io.find_traces(input_exact, exact_name, csv_ext)
+    _, examples, file_lookup = io.find_traces(input_exact, exact_name,
+                                              (csv_ext, npy_ext))
     for example in examples:
         original_chain, _ = example.rsplit(sep, 1)
         X_original = io.load_np(input_original, original_chain, csv_ext)
@@ -1,12 +1,16 @@
 # Ryan Turner (turnerry@iro.umontreal.ca)
 import cPickle as pkl
 import os
+from time import time
 import numpy as np
+import pymc3 as pm
 import scipy.stats as ss
 import theano
 import theano.tensor as T
 import phase2_train_benchmarks.model_wrappers as p2
 import phase3_benchmark.models as p3
+import phase4_analysis.diagnostics as p4d
+import phase4_analysis.metrics as p4m
 
 # This requires:
 # export PYTHONPATH=./phase2_train_benchmarks/bench_models/nade/:$PYTHONPATH
@@ -38,6 +42,15 @@ def test_model(input_path, params_file, N):
     v2 = np.array([logpdf_f(X[ii, :]) for ii in xrange(N)])
     print 'err2 %f' % np.log10(np.max(np.abs(v0 - v2)))
 
+    # Check batched version of logpdf agrees too
+    X_tt = T.matrix()
+    logpdf_tt = p3.BUILD_MODEL[model_name](X_tt, params_dict)
+    logpdf_f = theano.function([X_tt], logpdf_tt)
+
+    v3 = logpdf_f(X)
+    assert(v3.shape == (N,))
+    print 'err3 %f' % np.log10(np.max(np.abs(v0 - v3)))
+
 
 def test_mvn(runs=100):
     err = [0.0, 0.0, 0.0]
@@ -70,6 +83,144 @@ def test_mvn(runs=100):
     print 'mvn err P3 %f' % np.log10(err[1])
     print 'mvn err P2-P3 %f' % np.log10(err[2])
 
+
+def ar1_chains(n_chains, N, D):
+    '''AR(1) chains with random autocorrelation per dim, like MCMC output.'''
+    a = np.random.rand(D) * 0.9
+    chains = np.random.randn(n_chains, N, D)
+    for tt in xrange(1, N):
+        chains[:, tt, :] += a[None, :] * chains[:, tt - 1, :]
+    return chains
+
+
+def test_prefix_ks(runs=50):
+    '''prefix_ks() should match ks_2samp exactly on every prefix, including
+    ties in the exact sample and repeated values from rejected moves.'''
+    err = 0.0
+    for rr in xrange(runs):
+        M = np.random.randint(1, 200)
+        N = np.random.randint(1, 300)
+        D = np.random.randint(1, 4)
+
+        exact = np.round(np.random.randn(M, D), 1)
+        chain = np.round(np.random.randn(N, D), 1)
+        chain = np.repeat(chain, np.random.randint(1, 4, size=N), axis=0)[:N]
+        all_n = np.sort(np.random.randint(0, N + 1, size=10))
+
+        ks = p4m.prefix_ks(p4m.sort_marginals(exact), chain, all_n,
+                           block_size=np.random.randint(1, 50))
+        assert(ks.shape == (len(all_n), D))
+        for ii, n in enumerate(all_n):
+            if n == 0:
+                assert(np.all(np.isnan(ks[ii, :])))
+                continue
+            for jj in xrange(D):
+                ks_ref = ss.ks_2samp(exact[:, jj], chain[:n, jj])[0]
+                err = max(err, np.abs(ks[ii, jj] - ks_ref))
+                assert(np.allclose(ks[ii, jj], ks_ref))
+    print 'prefix ks err %f' % np.log10(err)
+
+
+def test_geweke(runs=50, max_intervals=20):
+    '''Vectorized geweke() should match the pymc3 one on every series.'''
+    err = 0.0
+    for rr in xrange(runs):
+        n_chains = np.random.randint(1, 4)
+        N = np.random.randint(20, 500)
+        D = np.random.randint(1, 4)
+        chains = ar1_chains(n_chains, N, D)
+
+        scores_pm = np.zeros((n_chains, D))
+        intervals = min(max_intervals, N // 10) + 1
+        for nn in xrange(n_chains):
+            for ii in xrange(D):
+                R = pm.diagnostics.geweke(chains[nn, :, ii],
+                                          intervals=intervals)
+                scores_pm[nn, ii] = np.mean(R[:, 1]) * np.sqrt(intervals)
+        scores_pm = np.mean(scores_pm, axis=0) * np.sqrt(n_chains)
+
+        scores = p4d.geweke(chains, max_intervals)
+        err = max(err, np.max(np.abs(scores - scores_pm)))
+        assert(np.allclose(scores, scores_pm))
+    print 'geweke err %f' % np.log10(err)
+
+
+def test_prefix_diagnostics(runs=50):
+    '''prefix_diagnostics() should match the batch diagnostics on each
+    prefix. ESS is only allowed to be nan, rather than match, when the prefix
+    is longer than max_lag.'''
+    err = 0.0
+    for rr in xrange(runs):
+        n_chains = np.random.randint(1, 4)
+        N = np.random.randint(20, 500)
+        D = np.random.randint(1, 4)
+        chains = ar1_chains(n_chains, N, D)
+        all_n = np.sort(np.random.randint(20, N + 1, size=5))
+        max_lag = np.random.choice([16, 64, 1024])
+
+        diags = p4d.prefix_diagnostics(list(chains), all_n, max_lag=max_lag,
+                                       block_size=np.random.randint(1, 100))
+        for ii, n in enumerate(all_n):
+            for name, diag_f in p4d.STD_DIAGNOSTICS.iteritems():
+                score = diags[name][ii, :]
+                score_ref = diag_f(chains[:, :n, :])
+                if name == p4d.ESS:
+                    assert(n > max_lag or not np.any(np.isnan(score)))
+                    keep = ~np.isnan(score)
+                    score, score_ref = score[keep], score_ref[keep]
+                assert(np.allclose(score, score_ref, equal_nan=True))
+                if np.all(np.isfinite(score_ref)) and len(score_ref) > 0:
+                    err = max(err, np.max(np.abs(score - score_ref)))
+    print 'prefix diagnostics err %f' % np.log10(err)
+
+
+def test_prefix_diagnostics_time(N=10 ** 5, D=100, n_grid=100, max_fac=5.0):
+    '''prefix_diagnostics() over the whole grid should cost about one pass
+    over the chain, so not much more than a single batch ESS.'''
+    chains = ar1_chains(1, N, D)
+    all_n = np.linspace(0, N, n_grid).astype(int)
+
+    t = time()
+    p4d.prefix_diagnostics(list(chains), all_n)
+    t_prefix = time() - t
+
+    t = time()
+    p4d.effective_n(chains)
+    t_batch = time() - t
+    print 'prefix diagnostics %fs, batch ESS %fs' % (t_prefix, t_batch)
+    assert(t_prefix <= max_fac * t_batch)
+
+
+def test_sync_views(runs=50):
+    '''Sync diagnostics and pooled metrics on chain views should match the
+    batch versions on the stacked chains.'''
+    err = 0.0
+    for rr in xrange(runs):
+        n_chains = np.random.randint(1, 4)
+        N = np.random.randint(20, 500)
+        D = np.random.randint(1, 4)
+        chains = ar1_chains(n_chains, N, D)
+
+        diags = p4d.sync_diagnostics(list(chains),
+                                     block_size=np.random.randint(1, 100))
+        for name, diag_f in p4d.STD_DIAGNOSTICS.iteritems():
+            score, score_ref = diags[name], diag_f(chains)
+            assert(np.allclose(score, score_ref, equal_nan=True))
+            if np.all(np.isfinite(score_ref)):
+                err = max(err, np.max(np.abs(score - score_ref)))
+
+        pooled = p4m.PooledChain(list(chains))
+        start, stop = np.sort(np.random.randint(0, n_chains * N + 1, size=2))
+        X = p4m.stack_first(chains)
+        assert(np.all(pooled[start:stop, :] == X[start:stop, :]))
+        exact_ref = {metric: (None,) for metric in p4m.MOMENT_METRICS}
+        estimates = p4m.eval_full(exact_ref, pooled, exact_ref.keys())
+        for metric, (_, approx) in estimates.iteritems():
+            approx_ref = p4m.MOMENT_METRICS[metric](X)
+            assert(np.allclose(approx, approx_ref))
+            err = max(err, np.max(np.abs(approx - approx_ref)))
+    print 'sync views err %f' % np.log10(err)
+
 np.random.seed(8525)
 
 # TODO go in config
@@ -80,6 +231,13 @@ N = 10
 # Also test our mvn implementations while we are at it
 test_mvn()
 
+# And the incremental phase 4 numerics against their batch versions
+test_prefix_ks()
+test_geweke()
+test_prefix_diagnostics()
+test_prefix_diagnostics_time()
+test_sync_views()
+
 params_file_list = sorted(os.listdir(input_path))
 for params_file in params_file_list:
     test_model(input_path, params_file, N)